@@ -1,4 +1,6 @@
 import asyncio
+import itertools
+import json
 import logging
 from arg_parser import parse_server_port
 from aioconsole import aprint
@@ -22,8 +24,45 @@ valid_commands = [
     "restart",
     "loglevel",
     "list",
+    "subscribe",
+    "tail",
+    "config",
+    "top",
+    "stats",
 ]
+multi_argument_commands = ["status", "subscribe", "tail", "restart", "top"]
 command_completer = WordCompleter(valid_commands, ignore_case=True)
+request_ids = itertools.count(1)
+
+
+def encode_request(request_id: int, command: str) -> bytes:
+    frame = json.dumps({"id": request_id, "command": command})
+    return frame.encode() + b"\n"
+
+
+def decode_response(message: str) -> tuple:
+    # Frames which are not JSON are returned as plain text with no id
+    try:
+        frame = json.loads(message)
+    except json.JSONDecodeError:
+        return None, message
+    if not isinstance(frame, dict):
+        return None, message
+    if "error" in frame:
+        return frame.get("id"), f"Error: {frame['error']}\n"
+    if "event" in frame:
+        event = frame["event"]
+        return frame.get("id"), (
+            f"[event] {event['process']}: {event['old_state']} -> "
+            f"{event['state']} (pid {event['pid']}, returncode "
+            f"{event['returncode']}, retries {event['retries']})\n"
+        )
+    response = frame.get("response", "")
+    if not isinstance(response, str):
+        response = json.dumps(response, indent=2)
+    if not response.endswith("\n"):
+        response += "\n"
+    return frame.get("id"), response
 
 
 def is_command_valid(input_command: str) -> bool:
@@ -32,6 +71,10 @@ def is_command_valid(input_command: str) -> bool:
         return False
     command = input_command.split()
 
+    # commands taking options are validated by the server
+    if command and command[0] in multi_argument_commands:
+        return True
+
     match len(command):
         case 0:
             return False
@@ -42,6 +85,8 @@ def is_command_valid(input_command: str) -> bool:
                 "reload",
                 "status",
                 "list",
+                "config",
+                "stats",
             ]:
                 logger.info("Not enough arguments. Usage: command [task_name]")
                 return False
@@ -75,11 +120,14 @@ async def listen_from_server(reader, should_run: dict):
             data = await reader.readline()
             message = data.decode("utf-8")
             if message:
-                should_run["waiting_for_response"] = False
                 if message.strip() == "server_shutdown":
                     should_run["active_connection"] = False
                     break
-                await aprint(message, end="")
+                request_id, response = decode_response(message)
+                should_run["pending_requests"].discard(request_id)
+                if not should_run["pending_requests"]:
+                    should_run["waiting_for_response"] = False
+                await aprint(response, end="")
     except Exception as e:
         logger.error(f"Error while listening for server messages: {e}")
 
@@ -140,7 +188,9 @@ async def send_user_commands(writer, should_run: dict):
                         should_run["active_connection"] = False
                         break
                     should_run["waiting_for_response"] = True
-                    writer.write(command.encode())
+                    request_id = next(request_ids)
+                    should_run["pending_requests"].add(request_id)
+                    writer.write(encode_request(request_id, command))
                     await writer.drain()
 
                     if command == "shutdown":
@@ -163,7 +213,11 @@ async def send_user_commands(writer, should_run: dict):
 
 
 async def start_client(host, port):
-    should_run = {"active_connection": True, "waiting_for_response": False}
+    should_run = {
+        "active_connection": True,
+        "waiting_for_response": False,
+        "pending_requests": set(),
+    }
     reader, writer = None, None
 
     try:
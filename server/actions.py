@@ -1,14 +1,32 @@
+import asyncio
 import logging
-from typing import Dict
+import time
+from typing import Dict, List, Set
 from program import Program
-from definitions import ProgramDefinition
-from dataclasses import dataclass
+from process import Process
+from definitions import ProgramDefinition, TaskMasterDefinition
 from config_parser import (
+    config_cache,
     config_file_parser,
     define_programs,
+    define_settings,
 )
 from exceptions import ProcessException, ProgramDefinitionError, ConfigError
 from taskmaster import TaskMaster
+from protocol import SHUTDOWN_MESSAGE
+from events import event_bus
+from spawner import spawner
+from reaper import reaper
+from timers import timers
+from watcher import watcher
+from sampler import sampler
+from metrics import exporter
+from monitor import monitor
+from mail import mailer
+from alerts import alert_dispatcher
+import capture
+import log_queue
+from dependencies import startup_layers
 
 logger = logging.getLogger(__name__)
 
@@ -20,39 +38,121 @@ def find_process_in_list(program_name: str, program_list: list[Program]):
     return None
 
 
-async def exit_action(programs: Dict[str, Program]):
+async def exit_action(programs: Dict[str, Program]) -> float:
     logger.debug("Exiting all processes...")
-    # await asyncio.gather(*[program.stop() for program in programs.values()])
+    started_at = time.monotonic()
+    # every process of a layer gets its stopsignal at once and is killed
+    # after its own stoptime, dependents are gone before their dependencies
+    for layer in reversed(startup_layers(programs)):
+        for program_name in layer:
+            programs[program_name].stop()
+        await asyncio.gather(
+            *[programs[name].wait_until_exited() for name in layer]
+        )
+    elapsed = time.monotonic() - started_at
+    logger.info(f"All processes exited in {elapsed:.2f}s")
+    return elapsed
+
+
+def apply_settings(taskmaster: TaskMaster, settings: TaskMasterDefinition):
+    if taskmaster.settings is None:
+        if settings.supervision == "reaper":
+            reaper.install()
+    elif settings.supervision != taskmaster.settings.supervision:
+        logger.warning(
+            "The supervision engine cannot change while children are "
+            f"running, keeping {taskmaster.settings.supervision}"
+        )
+        settings.supervision = taskmaster.settings.supervision
+    taskmaster.settings = settings
+    spawner.configure(settings.spawn_concurrency, settings.spawn_rate)
+    capture.configure(settings.logdir)
+    log_queue.configure(settings.log_queue_size, settings.log_overflow)
+    watcher.configure(
+        settings.watch_config,
+        settings.watch_debounce,
+        taskmaster.config_file,
+        lambda: reload_config_file(taskmaster),
+        config_cache,
+    )
+    sampler.configure(
+        settings.sample_interval, lambda: supervised_pids(taskmaster.programs)
+    )
+    mailer.configure(settings.mail_digest, settings.mail_queue_size)
+    monitor.configure(settings.slow_threshold)
+    monitor.start()
+    exporter.configure(
+        settings.metrics_host,
+        settings.metrics_port,
+        lambda: all_processes(taskmaster.programs),
+    )
+
+
+def all_processes(programs: Dict[str, Program]):
     for program in programs.values():
-        program.kill()
+        yield from program.processes.values()
 
 
-@dataclass
-class ProgramUpdate:
-    program: Program
-    definition: ProgramDefinition
+def supervised_pids(programs: Dict[str, Program]):
+    for program in programs.values():
+        for process in program.processes.values():
+            if process.is_alive():
+                yield process.name, process.process.pid
+
+
+def find_process(programs: Dict[str, Program], process_name: str) -> Process:
+    # `name-2` is the third process of `name`, `name` alone its first one
+    program = programs.get(process_name)
+    process_id = "0"
+    if program is None:
+        program_name, _, process_id = process_name.rpartition("-")
+        program = programs.get(program_name)
+    if program is None or not process_id.isdigit():
+        raise ProgramDefinitionError(f"Process {process_name} not found")
+    process = program.processes.get(int(process_id))
+    if process is None:
+        raise ProgramDefinitionError(f"Process {process_name} never started")
+    return process
 
 
 async def reload_config_file(taskmaster: TaskMaster) -> str:
     logger.info("Reloading config file...")
     programs_to_add: Dict[str, ProgramDefinition] = {}
     updated_programs: Dict[str, Program] = {}
+    removed_programs = 0
     try:
-        new_config = config_file_parser(taskmaster.config_file)
+        planning_started_at = time.monotonic()
+        new_config = await config_file_parser(taskmaster.config_file)
+        if config_cache.is_applied():
+            logger.info("Config file unchanged, nothing to reload")
+            return (
+                "Config file unchanged "
+                f"(sha256 {config_cache.digest[:12]}), nothing to reload"
+            )
+        new_settings = define_settings(new_config)
         new_programs_definition = await define_programs(new_config)
+        plans = {
+            name: program.plan_update(new_programs_definition[name])
+            for name, program in taskmaster.programs.items()
+            if name in new_programs_definition
+        }
+        planning_time = time.monotonic() - planning_started_at
+
+        applying_started_at = time.monotonic()
+        apply_settings(taskmaster, new_settings)
         for old_program_name, old_program in taskmaster.programs.items():
             # old process group that is no longer in config
             if old_program_name not in new_programs_definition.keys():
                 logger.debug(
                     f"Process group {old_program_name} is no longer in config, killing Program..."
                 )
-                old_program.kill()
+                old_program.remove()
+                removed_programs += 1
             else:
-                logger.debug(
-                    f"Process group {old_program_name} is still in config, updating..."
+                old_program.apply_update(
+                    new_programs_definition[old_program_name],
+                    plans[old_program_name],
                 )
-                # compare old and new programs
-                old_program.update(new_programs_definition[old_program_name])
                 updated_programs[old_program_name] = old_program
 
         # new process groups which where not in old process group list
@@ -74,20 +174,154 @@ async def reload_config_file(taskmaster: TaskMaster) -> str:
         # update changed programs
         taskmaster.programs = updated_programs
         taskmaster.programs_definition = new_programs_definition
-
-        logger.info("Config file reloaded successfully")
+        config_cache.mark_applied()
+        applying_time = time.monotonic() - applying_started_at
     except (ProgramDefinitionError, ConfigError) as e:
         logger.info(f"Error reloading config file: {e}")
         return f"Error reloading config file: {e}"
-    return "Reloaded config file successfully"
+    changed = [plan for plan in plans.values() if plan.differences]
+    summary = (
+        f"{len(changed)} programs changed, "
+        f"{sum(len(plan.respawn) for plan in changed)} processes respawned, "
+        f"{sum(len(plan.added) for plan in changed)} added, "
+        f"{sum(len(plan.removed) for plan in changed)} removed, "
+        f"{len(programs_to_add)} programs added, "
+        f"{removed_programs} programs removed"
+    )
+    timing = (
+        f"planned in {planning_time * 1000:.1f}ms, "
+        f"applied in {applying_time * 1000:.1f}ms"
+    )
+    logger.info(f"Config file reloaded successfully: {summary} ({timing})")
+    return f"Reloaded config file successfully: {summary} ({timing})"
+
+
+def config_snapshot(taskmaster: TaskMaster) -> dict:
+    return {
+        "path": str(taskmaster.config_file),
+        **config_cache.get_stats(),
+        "watch": watcher.get_stats(),
+    }
+
+
+def show_config(taskmaster: TaskMaster) -> str:
+    config = config_snapshot(taskmaster)
+    return (
+        f"{config['path']}: sha256 {config['sha256']}, "
+        f"{config['size']} bytes parsed in "
+        f"{config['parse_time'] * 1000:.1f}ms, {config['programs']} programs "
+        f"({config['reused']} unchanged on last load)"
+        + ("" if config["applied"] else ", not applied")
+    )
+
+
+def stats_snapshot() -> dict:
+    return {
+        **monitor.get_stats(),
+        "spawner": spawner.get_stats(),
+        "timers": timers.get_stats(),
+        "sampler": sampler.get_stats(),
+        "log_queue": log_queue.get_stats(),
+        "mail": mailer.get_stats(),
+        "alerts": alert_dispatcher.get_stats(),
+    }
+
+
+def show_stats() -> str:
+    stats = monitor.get_stats()
+    lag = stats["lag_histogram"]
+    lines = [
+        f"event loop lag: {stats['loop_lag'] * 1000:.1f}ms "
+        f"(max {stats['max_loop_lag'] * 1000:.1f}ms, "
+        f"p99 <= {lag['p99'] * 1000:g}ms over {lag['count']} probes)",
+        f"blocked loop: {stats['slow_callbacks']} times, "
+        f"slow commands: {stats['slow_commands']} "
+        f"(threshold {stats['slow_threshold']}s)",
+        f"{'COMMAND':<12} {'COUNT':>7} {'AVG':>9} {'P50':>9} "
+        f"{'P99':>9} {'MAX':>9}",
+    ]
+    for command, histogram in sorted(stats["commands"].items()):
+        average = histogram["total"] / histogram["count"]
+        lines.append(
+            f"{command:<12} {histogram['count']:>7} "
+            f"{average * 1000:>7.2f}ms {histogram['p50'] * 1000:>7g}ms "
+            f"{histogram['p99'] * 1000:>7g}ms "
+            f"{histogram['max'] * 1000:>7.2f}ms"
+        )
+    return "\n".join(lines)
+
+
+def select_programs(
+    programs: Dict[str, Program], program_names: List[str]
+) -> List[Program]:
+    if not program_names:
+        return list(programs.values())
+    unknown = [name for name in program_names if name not in programs]
+    if unknown:
+        raise ProgramDefinitionError(
+            f"Process group {', '.join(unknown)} not in config file"
+        )
+    return [programs[name] for name in program_names]
 
 
-def show_status(programs: Dict[str, Program], return_string: str) -> str:
+def show_status(
+    programs: Dict[str, Program],
+    return_string: str,
+    program_names: List[str] = None,
+    states: Set[str] = None,
+) -> str:
     logger.debug("Showing status...")
-    for program in programs.values():
-        return_string += f"{program.name}:\n"
-        return_string += f"{program.get_status()}\n"
-    return return_string
+    lines = [return_string]
+    for program in select_programs(programs, program_names):
+        program_status = program.get_status(states)
+        if states and not program_status:
+            continue
+        lines.append(f"{program.name}:\n")
+        lines.append(f"{program_status}\n")
+    return "".join(lines)
+
+
+def status_snapshot(
+    programs: Dict[str, Program],
+    program_names: List[str] = None,
+    states: Set[str] = None,
+    since: int = None,
+) -> dict:
+    logger.debug("Building status snapshot...")
+    selected = select_programs(programs, program_names)
+    version = event_bus.version
+    if since is not None:
+        removed = event_bus.removed_since(since)
+        if removed is not None:
+            selected_names = {program.name for program in selected}
+            processes = [
+                process.get_snapshot()
+                for process in event_bus.changed_since(since)
+                if process.program_name in selected_names
+                and (not states or process.status.value in states)
+            ]
+            return {
+                "version": version,
+                "since": since,
+                "processes": processes,
+                "removed": removed,
+                "spawner": spawner.get_stats(),
+                "fds": capture.fd_usage(),
+                "timers": timers.get_stats(),
+                "sampler": sampler.get_stats(),
+            }
+        logger.debug(f"Version {since} cannot be diffed, sending full snapshot")
+    processes = []
+    for program in selected:
+        processes.extend(program.get_snapshot(states))
+    return {
+        "version": version,
+        "processes": processes,
+        "spawner": spawner.get_stats(),
+        "fds": capture.fd_usage(),
+        "timers": timers.get_stats(),
+        "sampler": sampler.get_stats(),
+    }
 
 
 async def launch_programs(
@@ -96,9 +330,25 @@ async def launch_programs(
 ) -> Dict[str, Program]:
     for program_name, program_definition in program_definitions.items():
         try:
-            program = Program(program_definition)
-            programs[program_name] = program
-            if program.autostart:
+            programs[program_name] = Program(program_definition)
+        except Exception as e:
+            raise ProcessException(
+                f"Error creating process {program_name}: {e}"
+            )
+    # queue spawns by priority so the spawn scheduler serves them in order,
+    # programs with dependencies start once these are RUNNING
+    for program_name in sorted(
+        program_definitions, key=lambda name: programs[name].priority
+    ):
+        program = programs[program_name]
+        try:
+            if not program.autostart:
+                continue
+            if program.depends_on:
+                program.start_after(
+                    [programs[name] for name in program.depends_on]
+                )
+            else:
                 program.start()
         except Exception as e:
             raise ProcessException(
@@ -108,27 +358,85 @@ async def launch_programs(
 
 
 async def shutdown(taskmaster: TaskMaster):
+    if taskmaster.shutting_down:
+        logger.debug("Shutdown already in progress")
+        return
+    taskmaster.shutting_down = True
     logger.info("\nShutting down server...")
+    started_at = time.monotonic()
 
     # Close all active client connections and prevent
     connections = list(taskmaster.active_connections.keys())
-    shutdown_message = "server_shutdown"
+    shutdown_message = SHUTDOWN_MESSAGE + "\n"
     for addr in connections:
-        writer = taskmaster.active_connections[addr]
-        if writer:
+        writer = taskmaster.active_connections.get(addr)
+        if writer and not writer.is_closing():
             writer.write(shutdown_message.encode())
             await writer.drain()  # Assurez-vous que le message est envoyé.
             writer.close()
             await writer.wait_closed()
 
+    watcher.stop()
+    sampler.stop()
+    monitor.stop()
+    await exporter.stop()
+    # closing the server ends the main task, processes are stopped first
+    await exit_action(taskmaster.programs)
+    # alerts of the last digest are sent before leaving
+    await alert_dispatcher.stop()
+    await mailer.stop()
+    await capture.writer_pool.close_all()
     taskmaster.server.close()
     await taskmaster.server.wait_closed()
-    await exit_action(taskmaster.programs)
-    logger.info("Server is closed")
+    elapsed = time.monotonic() - started_at
+    logger.info(f"Server is closed, shutdown took {elapsed:.2f}s")
+
+
+TOP_COLUMNS = ["cpu", "rss", "fds"]
+
+
+def top_processes(
+    programs: Dict[str, Program], sort: str = "cpu", limit: int = 20
+) -> List[dict]:
+    rows = []
+    for program in programs.values():
+        for process in program.processes.values():
+            resources = sampler.get(process.name)
+            if resources is None or not process.is_alive():
+                continue
+            rows.append(
+                {
+                    "name": process.name,
+                    "pid": process.process.pid,
+                    "state": process.status.value,
+                    **resources,
+                }
+            )
+    rows.sort(key=lambda row: row[sort], reverse=True)
+    return rows[:limit]
+
+
+def show_top(rows: List[dict]) -> str:
+    lines = [f"{'NAME':<24} {'PID':>8} {'CPU%':>6} {'RSS':>10} {'FDS':>5}"]
+    for row in rows:
+        lines.append(
+            f"{row['name']:<24} {row['pid']:>8} {row['cpu']:>6.1f} "
+            f"{format_bytes(row['rss']):>10} {row['fds']:>5}"
+        )
+    return "\n".join(lines)
+
+
+def format_bytes(size: int) -> str:
+    for unit in ["B", "KB", "MB"]:
+        if size < 1024:
+            return f"{size:.0f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
 
 
 def list_programs(programs: Dict[str, Program], return_string: str) -> str:
     logger.debug("Listing programs...")
+    lines = [return_string]
     for program in programs.values():
-        return_string += f"{program.name}\n"
-    return return_string
+        lines.append(f"{program.name}\n")
+    return "".join(lines)
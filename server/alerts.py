@@ -0,0 +1,238 @@
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import syslog
+import time
+import urllib.request
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable
+
+from definitions import AlertSink
+from mail import mailer
+from reaper import reaper
+
+logger = logging.getLogger(__name__)
+
+ALERT_EVENTS = ["ABORTED", "FATAL", "BACKOFF", "FLAPPING"]
+# sink type and the key of its target in the configuration
+SINK_TYPES = {
+    "mail": None,
+    "webhook": "url",
+    "command": "command",
+    "syslog": "facility",
+}
+SYSLOG_FACILITIES = {
+    "user": syslog.LOG_USER,
+    "daemon": syslog.LOG_DAEMON,
+    **{f"local{index}": syslog.LOG_LOCAL0 + index * 8 for index in range(8)},
+}
+SYSLOG_PRIORITIES = {
+    "ABORTED": syslog.LOG_CRIT,
+    "FATAL": syslog.LOG_ERR,
+    "FLAPPING": syslog.LOG_WARNING,
+    "BACKOFF": syslog.LOG_NOTICE,
+}
+ALERT_QUEUE_SIZE = 100  # alerts waiting per sink
+RETRY_DELAY = 1.0  # seconds before the first retry, doubled after each
+FLUSH_TIMEOUT = 5  # seconds to deliver pending alerts on shutdown
+
+
+@dataclass
+class Alert:
+    event: str
+    program: str
+    process: str
+    message: str
+    pid: int = None
+    returncode: int = None
+    retries: int = 0
+    time: float = 0
+
+
+def post_webhook(url: str, alert: Alert, timeout: float):
+    # runs in the executor, any HTTP error status raises
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(asdict(alert)).encode(),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        response.read()
+
+
+async def run_command(command: str, alert: Alert, timeout: float):
+    # the alert is passed in the environment of the hook
+    env = {
+        **os.environ,
+        "TASKMASTER_EVENT": alert.event,
+        "TASKMASTER_PROGRAM": alert.program,
+        "TASKMASTER_PROCESS": alert.process,
+        "TASKMASTER_MESSAGE": alert.message,
+        "TASKMASTER_ALERT": json.dumps(asdict(alert)),
+    }
+    streams = {
+        "stdin": subprocess.DEVNULL,
+        "stdout": subprocess.DEVNULL,
+        "stderr": subprocess.DEVNULL,
+    }
+    if reaper.enabled:
+        # the reaper collects every child of the server
+        process = await reaper.spawn(
+            ["/bin/sh", "-c", command], lambda _: None, env=env, **streams
+        )
+    else:
+        process = await asyncio.create_subprocess_shell(
+            command, env=env, **streams
+        )
+    try:
+        returncode = await asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        raise TimeoutError(f"`{command}` did not exit in {timeout}s")
+    if returncode != 0:
+        raise RuntimeError(f"`{command}` exited with code {returncode}")
+
+
+def write_syslog(facility: str, alert: Alert):
+    syslog.syslog(
+        SYSLOG_FACILITIES[facility] | SYSLOG_PRIORITIES[alert.event],
+        f"{alert.process} {alert.event}: {alert.message}",
+    )
+
+
+class SinkWorker:
+    # Delivers the alerts of one sink in order, retrying failures with an
+    # exponential delay. Alerts beyond `rate` per minute are dropped, so a
+    # crash storm cannot flood a webhook or spawn hundreds of hooks.
+
+    def __init__(self, sink: AlertSink):
+        self.sink = sink
+        self.queue = asyncio.Queue(ALERT_QUEUE_SIZE)
+        self.tokens = sink.rate
+        self.refilled_at = time.monotonic()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.limited = 0
+        self.task = asyncio.create_task(self.run())
+
+    def allow(self) -> bool:
+        if not self.sink.rate:
+            return True
+        now = time.monotonic()
+        self.tokens = min(
+            self.sink.rate,
+            self.tokens + (now - self.refilled_at) * self.sink.rate / 60,
+        )
+        self.refilled_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def push(self, alert: Alert):
+        if not self.allow():
+            self.limited += 1
+            logger.debug(f"Alert rate limit of {self.name} reached")
+            return
+        try:
+            self.queue.put_nowait(alert)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"Alert queue of {self.name} full, alert dropped")
+
+    @property
+    def name(self) -> str:
+        return f"{self.sink.type}:{self.sink.target}".rstrip(":")
+
+    async def run(self):
+        while True:
+            alert = await self.queue.get()
+            try:
+                await self.deliver(alert)
+            finally:
+                self.queue.task_done()
+
+    async def deliver(self, alert: Alert):
+        for attempt in range(self.sink.retries + 1):
+            try:
+                await self.send(alert)
+                self.sent += 1
+                return
+            except Exception as e:
+                error = e
+            if attempt < self.sink.retries:
+                await asyncio.sleep(RETRY_DELAY * 2**attempt)
+        self.failed += 1
+        logger.error(
+            f"Alert {alert.event} of {alert.process} not delivered to "
+            f"{self.name}: {error}"
+        )
+
+    async def send(self, alert: Alert):
+        loop = asyncio.get_running_loop()
+        if self.sink.type == "mail":
+            mailer.alert(
+                f"Process {alert.process} {alert.event}", alert.message
+            )
+        elif self.sink.type == "webhook":
+            await loop.run_in_executor(
+                None, post_webhook, self.sink.target, alert, self.sink.timeout
+            )
+        elif self.sink.type == "command":
+            await run_command(self.sink.target, alert, self.sink.timeout)
+        elif self.sink.type == "syslog":
+            await loop.run_in_executor(
+                None, write_syslog, self.sink.target, alert
+            )
+
+    def get_stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "limited": self.limited,
+        }
+
+
+class AlertDispatcher:
+    # One worker per distinct sink definition, shared by every program
+    # using it, so its rate limit holds whatever the number of programs
+
+    def __init__(self):
+        self.workers: Dict[AlertSink, SinkWorker] = {}
+
+    def notify(self, sinks: Iterable[AlertSink], alert: Alert):
+        for sink in sinks:
+            if alert.event not in sink.events:
+                continue
+            worker = self.workers.get(sink)
+            if worker is None:
+                worker = self.workers[sink] = SinkWorker(sink)
+            worker.push(alert)
+
+    async def stop(self):
+        workers = list(self.workers.values())
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*[worker.queue.join() for worker in workers]),
+                FLUSH_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            logger.error("Pending alerts could not be delivered in time")
+        for worker in workers:
+            worker.task.cancel()
+        self.workers.clear()
+
+    def get_stats(self) -> dict:
+        return {
+            worker.name: worker.get_stats()
+            for worker in self.workers.values()
+        }
+
+
+alert_dispatcher = AlertDispatcher()
@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import os
+from collections import deque
+import resource
+from typing import Dict, List, Set
+
+logger = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 64 * 1024
+RING_BUFFER_SIZE = 256 * 1024  # bytes kept in memory for each stream
+FLUSH_INTERVAL = 1.0  # seconds between two writes to the log file
+FLUSH_SIZE = 256 * 1024  # pending bytes which trigger an early write
+FOLLOWER_QUEUE_SIZE = 256
+DEFAULT_LOG_DIRECTORY = "./logs"
+DEFAULT_LOGFILE_MAXBYTES = 50 * 1024 * 1024
+DEFAULT_LOGFILE_BACKUPS = 10
+DISCARD_OUTPUT = "/dev/null"
+
+log_directory = DEFAULT_LOG_DIRECTORY
+
+
+def configure(directory: str):
+    global log_directory
+    log_directory = directory
+
+
+def capture_path(process_name: str, stream_name: str) -> str:
+    return os.path.join(log_directory, f"{process_name}.{stream_name}")
+
+
+class BatchWriter:
+    # Collects chunks in memory and appends them to `path` in batches,
+    # the file I/O runs in the default executor, off the event loop.
+    # Once `path` would grow beyond `max_bytes` it is rotated to
+    # `path.1` ... `path.<backups>` (0 max_bytes disables rotation).
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = DEFAULT_LOGFILE_MAXBYTES,
+        backups: int = DEFAULT_LOGFILE_BACKUPS,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file_size: int = None
+        self.file = None
+        self.pending: List[bytes] = []
+        self.pending_size = 0
+        self.flush_task: asyncio.Task = None
+        self.lock = asyncio.Lock()
+
+    def write(self, data: bytes):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        try:
+            while self.pending:
+                if self.pending_size < FLUSH_SIZE:
+                    await asyncio.sleep(FLUSH_INTERVAL)
+                await self.flush()
+        finally:
+            self.flush_task = None
+
+    async def flush(self):
+        # the lock keeps batches in order when flushes overlap
+        async with self.lock:
+            if not self.pending:
+                return
+            data = b"".join(self.pending)
+            self.pending.clear()
+            self.pending_size = 0
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.write_file, data
+                )
+            except Exception as e:
+                logger.error(f"Error writing output to {self.path}: {e}")
+
+    def write_file(self, data: bytes):
+        if self.file is None:
+            self.file = open(self.path, "ab")
+            self.file_size = self.file.tell()
+        if (
+            self.max_bytes
+            and self.file_size
+            and self.file_size + len(data) > self.max_bytes
+        ):
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.file_size += len(data)
+
+    def rotate(self):
+        self.file.close()
+        if self.backups > 0:
+            for index in range(self.backups - 1, 0, -1):
+                source = f"{self.path}.{index}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+            self.file = open(self.path, "ab")
+        else:
+            self.file = open(self.path, "wb")
+        self.file_size = 0
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    async def close(self):
+        await self.flush()
+        async with self.lock:
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.close_file
+                )
+            except Exception as e:
+                logger.error(f"Error closing {self.path}: {e}")
+                return
+        logger.debug(f"Closed log file {self.path}")
+
+
+class WriterPool:
+    # Log files are opened once per path, shared by every process writing
+    # to that path, and closed as soon as the last of them releases it
+
+    def __init__(self):
+        self.writers: Dict[str, BatchWriter] = {}
+        self.references: Dict[str, int] = {}
+        self.closing: Set[asyncio.Task] = set()
+
+    def acquire(
+        self, path: str, max_bytes: int, backups: int
+    ) -> BatchWriter:
+        path = os.path.abspath(path)
+        writer = self.writers.get(path)
+        if writer is None:
+            writer = BatchWriter(path, max_bytes, backups)
+            self.writers[path] = writer
+            self.references[path] = 0
+        elif (writer.max_bytes, writer.backups) != (max_bytes, backups):
+            logger.debug(
+                f"{path} is shared, keeping its first rotation settings"
+            )
+        self.references[path] += 1
+        return writer
+
+    def release(self, writer: BatchWriter):
+        if self.writers.get(writer.path) is not writer:
+            return
+        self.references[writer.path] -= 1
+        if self.references[writer.path] > 0:
+            return
+        del self.writers[writer.path]
+        del self.references[writer.path]
+        task = asyncio.create_task(writer.close())
+        self.closing.add(task)
+        task.add_done_callback(self.closing.discard)
+
+    async def close_all(self):
+        writers = list(self.writers.values())
+        self.writers.clear()
+        self.references.clear()
+        await asyncio.gather(
+            *self.closing, *[writer.close() for writer in writers]
+        )
+
+    def open_files(self) -> int:
+        return sum(
+            1 for writer in self.writers.values() if writer.file is not None
+        )
+
+
+writer_pool = WriterPool()
+
+
+def fd_usage() -> dict:
+    try:
+        open_fds = len(os.listdir("/proc/self/fd"))
+    except OSError:
+        open_fds = None
+    return {
+        "open": open_fds,
+        "limit": resource.getrlimit(resource.RLIMIT_NOFILE)[0],
+        "log_files": writer_pool.open_files(),
+        "log_writers": len(writer_pool.writers),
+    }
+
+
+class OutputLog:
+    # Bounded in-memory ring buffer of a process output stream. Chunks are
+    # also handed to the BatchWriter attached while the process runs, and
+    # complete lines to the `tail -f` followers.
+
+    def __init__(self, name: str):
+        self.name = name
+        self.writer: BatchWriter = None
+        self.chunks: deque = deque()
+        self.size = 0
+        self.partial_line = b""
+        self.followers: Set[asyncio.Queue] = set()
+        # runs of the process, each reader owns the writer of its run
+        self.run = 0
+
+    def append(self, data: bytes):
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size > RING_BUFFER_SIZE and len(self.chunks) > 1:
+            self.size -= len(self.chunks.popleft())
+        if self.writer:
+            self.writer.write(data)
+        if self.followers:
+            self.publish_lines(data)
+
+    def publish_lines(self, data: bytes):
+        data = self.partial_line + data
+        lines, separator, self.partial_line = data.rpartition(b"\n")
+        if not separator:
+            self.partial_line = lines
+            return
+        text = lines.decode(errors="replace")
+        for queue in self.followers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(text)
+
+    def tail(self, lines: int = 10) -> str:
+        # [-0:] would be the whole buffer
+        if lines <= 0:
+            return ""
+        content = b"".join(self.chunks).decode(errors="replace")
+        return "\n".join(content.splitlines()[-lines:])
+
+    def follow(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=FOLLOWER_QUEUE_SIZE)
+        self.followers.add(queue)
+        return queue
+
+    def unfollow(self, queue: asyncio.Queue):
+        self.followers.discard(queue)
+
+    def attach(self, writer: BatchWriter):
+        self.detach()
+        self.writer = writer
+
+    def detach(self):
+        if self.writer:
+            writer_pool.release(self.writer)
+            self.writer = None
+
+    def start_run(self, writer: BatchWriter) -> int:
+        self.attach(writer)
+        self.run += 1
+        return self.run
+
+    def end_run(self, run: int):
+        # a reader which outlived its run (a retry started before its EOF,
+        # a grandchild holding the pipe) leaves the new run's writer alone
+        if run == self.run:
+            # the log file is closed once no process writes to it
+            self.detach()
+
+    async def capture(self, stream: asyncio.StreamReader, run: int):
+        try:
+            while True:
+                data = await stream.read(READ_CHUNK_SIZE)
+                if not data:
+                    break
+                self.append(data)
+        finally:
+            self.end_run(run)
+            logger.debug(f"{self.name} reader stopped")
@@ -1,25 +1,344 @@
 from actions import (
+    config_snapshot,
+    find_process,
     show_status,
+    status_snapshot,
     reload_config_file,
     shutdown,
-    list_programs
+    list_programs,
+    show_config,
+    show_stats,
+    stats_snapshot,
+    show_top,
+    top_processes,
+    TOP_COLUMNS,
 )
+import asyncio
 import logging
+import time
+from typing import Any, Awaitable, Callable, List
 
+from enums import Status
+from events import event_bus
+from monitor import monitor
+from capture import OutputLog
+from exceptions import ProgramDefinitionError
 from taskmaster import TaskMaster
 
 logger = logging.getLogger(__name__)
 
+STATUS_USAGE = "usage: status [--json [--since VERSION]] [--state STATE[,STATE...]] [task_name ...]"
+SUBSCRIBE_USAGE = "usage: subscribe [--state STATE[,STATE...]] [task_name ...]"
+TAIL_USAGE = "usage: tail [-f] [-n LINES] [--stderr] process_name"
+TOP_USAGE = "usage: top [--json] [--sort cpu|rss|fds] [-n LINES]"
+RESTART_USAGE = "usage: restart [--rolling [--batch SIZE|PERCENT%]] task_name"
+AVAILABLE_COMMANDS = (
+    "Available commands: start, stop, restart, restart --rolling, reload, "
+    "status, subscribe, tail, top, stats, config, list, loglevel, shutdown, "
+    "exit"
+)
+# commands timed under their own name, anything else is "unknown"
+COMMANDS = [
+    "start",
+    "stop",
+    "restart",
+    "reload",
+    "shutdown",
+    "status",
+    "list",
+    "loglevel",
+    "subscribe",
+    "tail",
+    "config",
+    "top",
+    "stats",
+]
+
+
+def parse_status_arguments(
+    arguments: List[str], usage: str = STATUS_USAGE
+) -> dict:
+    options = {"json": False, "programs": [], "states": set(), "since": None}
+    arguments = iter(arguments)
+    for argument in arguments:
+        if argument == "--json" and usage == STATUS_USAGE:
+            options["json"] = True
+        elif argument == "--since" and usage == STATUS_USAGE:
+            value = next(arguments, None)
+            if value is None or not value.isdigit():
+                raise ValueError(f"Invalid value for --since. {usage}")
+            options["since"] = int(value)
+        elif argument == "--state":
+            value = next(arguments, None)
+            if value is None:
+                raise ValueError(f"Missing value for --state. {usage}")
+            for state in value.upper().split(","):
+                if state not in Status.__members__:
+                    raise ValueError(
+                        f"Invalid state: {state}, valid states: "
+                        + ", ".join(Status.__members__)
+                    )
+                options["states"].add(state)
+        elif argument.startswith("--"):
+            raise ValueError(f"Unknown option: {argument}. {usage}")
+        else:
+            options["programs"].append(argument)
+    return options
+
+
+def handle_status(arguments: List[str], taskmaster: TaskMaster):
+    try:
+        options = parse_status_arguments(arguments)
+        if options["json"]:
+            return status_snapshot(
+                taskmaster.programs,
+                options["programs"],
+                options["states"],
+                options["since"],
+            )
+        if options["since"] is not None:
+            raise ValueError(f"--since requires --json. {STATUS_USAGE}")
+        return show_status(
+            taskmaster.programs, "", options["programs"], options["states"]
+        )
+    except (ValueError, ProgramDefinitionError) as e:
+        logger.info(str(e))
+        return str(e)
+
+
+def parse_tail_arguments(arguments: List[str]) -> dict:
+    options = {"follow": False, "lines": 10, "stream": "stdout", "process": None}
+    arguments = iter(arguments)
+    for argument in arguments:
+        if argument == "-f":
+            options["follow"] = True
+        elif argument == "-n":
+            value = next(arguments, None)
+            try:
+                options["lines"] = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid value for -n. {TAIL_USAGE}")
+            if options["lines"] < 0:
+                raise ValueError(f"-n must be 0 or more. {TAIL_USAGE}")
+        elif argument == "--stderr":
+            options["stream"] = "stderr"
+        elif argument.startswith("-") or options["process"]:
+            raise ValueError(f"Invalid argument: {argument}. {TAIL_USAGE}")
+        else:
+            options["process"] = argument
+    if options["process"] is None:
+        raise ValueError(f"Missing process name. {TAIL_USAGE}")
+    return options
+
+
+def parse_restart_arguments(arguments: List[str]) -> dict:
+    options = {"rolling": False, "batch": None, "program": None}
+    arguments = iter(arguments)
+    for argument in arguments:
+        if argument == "--rolling":
+            options["rolling"] = True
+        elif argument == "--batch":
+            value = next(arguments, None)
+            if value is None:
+                raise ValueError(f"Missing value for --batch. {RESTART_USAGE}")
+            options["batch"] = value
+        elif argument.startswith("-") or options["program"]:
+            raise ValueError(f"Invalid argument: {argument}. {RESTART_USAGE}")
+        else:
+            options["program"] = argument
+    if options["program"] is None:
+        raise ValueError(f"Missing task name. {RESTART_USAGE}")
+    return options
+
+
+async def handle_restart(arguments: List[str], taskmaster: TaskMaster) -> str:
+    try:
+        options = parse_restart_arguments(arguments)
+        task = taskmaster.programs.get(options["program"])
+        if task is None:
+            raise ValueError(
+                f"Process group {options['program']} not in config file"
+            )
+        if not options["rolling"]:
+            return task.restart()
+        # the program's `rolling_batch`, else one process at a time
+        rolling_task = task.restart_rolling(
+            options["batch"] or task.rolling_batch or "1"
+        )
+    except ValueError as e:
+        logger.info(str(e))
+        return str(e)
+    try:
+        return await rolling_task
+    except asyncio.CancelledError:
+        if not rolling_task.cancelled():
+            raise
+        return f"Rolling restart of task {task.name} cancelled"
+
+
+def parse_top_arguments(arguments: List[str]) -> dict:
+    options = {"json": False, "sort": "cpu", "lines": 20}
+    arguments = iter(arguments)
+    for argument in arguments:
+        if argument == "--json":
+            options["json"] = True
+        elif argument == "--sort":
+            value = next(arguments, None)
+            if value not in TOP_COLUMNS:
+                raise ValueError(f"Invalid value for --sort. {TOP_USAGE}")
+            options["sort"] = value
+        elif argument == "-n":
+            value = next(arguments, None)
+            if value is None or not value.isdigit():
+                raise ValueError(f"Invalid value for -n. {TOP_USAGE}")
+            options["lines"] = int(value)
+        else:
+            raise ValueError(f"Invalid argument: {argument}. {TOP_USAGE}")
+    return options
+
+
+def handle_top(arguments: List[str], taskmaster: TaskMaster):
+    try:
+        options = parse_top_arguments(arguments)
+    except ValueError as e:
+        logger.info(str(e))
+        return str(e)
+    rows = top_processes(
+        taskmaster.programs, options["sort"], options["lines"]
+    )
+    if options["json"]:
+        return {"processes": rows}
+    return show_top(rows)
+
+
+def find_output_log(options: dict, taskmaster: TaskMaster) -> OutputLog:
+    process = find_process(taskmaster.programs, options["process"])
+    output_log = process.get_output_log(options["stream"])
+    if output_log is None:
+        raise ValueError(
+            f"{options['stream']} of process {process.name} is not captured"
+        )
+    return output_log
+
+
+def handle_tail(arguments: List[str], taskmaster: TaskMaster) -> str:
+    try:
+        options = parse_tail_arguments(arguments)
+        return find_output_log(options, taskmaster).tail(options["lines"])
+    except (ValueError, ProgramDefinitionError) as e:
+        logger.info(str(e))
+        return str(e)
+
+
+async def handle_follow(
+    arguments: List[str],
+    taskmaster: TaskMaster,
+    send: Callable[[Any], Awaitable[None]],
+):
+    try:
+        options = parse_tail_arguments(arguments)
+        output_log = find_output_log(options, taskmaster)
+    except (ValueError, ProgramDefinitionError) as e:
+        logger.info(str(e))
+        await send(str(e))
+        return
+    queue = output_log.follow()
+    try:
+        history = output_log.tail(options["lines"])
+        if history:
+            await send(history)
+        while True:
+            await send(await queue.get())
+    finally:
+        output_log.unfollow(queue)
+
+
+def is_streaming_command(command: str) -> bool:
+    command = command.split()
+    if not command:
+        return False
+    return command[0] == "subscribe" or (
+        command[0] == "tail" and "-f" in command
+    )
+
+
+async def handle_subscription(
+    arguments: List[str], send: Callable[[Any], Awaitable[None]]
+):
+    try:
+        options = parse_status_arguments(arguments, SUBSCRIBE_USAGE)
+    except ValueError as e:
+        logger.info(str(e))
+        await send(str(e))
+        return
+    subscriber = event_bus.subscribe(options["programs"], options["states"])
+    await send("Subscribed to process state changes")
+    try:
+        while True:
+            event = await subscriber.queue.get()
+            dropped = subscriber.take_dropped()
+            if dropped:
+                logger.info(f"Slow subscriber: {dropped} events dropped")
+            await send(event)
+    finally:
+        event_bus.unsubscribe(subscriber)
+
+
+async def handle_stream(
+    command: str,
+    taskmaster: TaskMaster,
+    send: Callable[[Any], Awaitable[None]],
+):
+    logger.debug(f"Streaming command: {command}")
+    command = command.split()
+    match command[0]:
+        case "subscribe":
+            await handle_subscription(command[1:], send)
+        case "tail":
+            await handle_follow(command[1:], taskmaster, send)
+
 
 async def handle_command(
     command: str, taskmaster: TaskMaster, root_logger: logging.Logger
-) -> str:
+) -> str | dict:
+    started_at = time.monotonic()
+    try:
+        return await dispatch_command(command, taskmaster, root_logger)
+    finally:
+        # labels are bounded: a client cannot create a histogram per typo
+        name = command.split()[0] if command.split() else ""
+        if name not in COMMANDS:
+            name = "unknown"
+        monitor.record_command(name, time.monotonic() - started_at)
+
+
+async def dispatch_command(
+    command: str, taskmaster: TaskMaster, root_logger: logging.Logger
+) -> str | dict:
     logger.debug(f"Command: {command}")
     command = command.split()
     return_string = ""
     if len(command) == 0:
         return ""
-    if len(command) == 1 and command[0] in ["shutdown", "reload", "status", "list"]:
+    if command[0] == "status":
+        return handle_status(command[1:], taskmaster)
+    if command[0] == "tail":
+        return handle_tail(command[1:], taskmaster)
+    if command[0] == "top":
+        return handle_top(command[1:], taskmaster)
+    if command[0] == "restart" and len(command) > 2:
+        return await handle_restart(command[1:], taskmaster)
+    if command == ["list", "--json"]:
+        return {"programs": list(taskmaster.programs.keys())}
+    if command == ["config"]:
+        return show_config(taskmaster)
+    if command == ["config", "--json"]:
+        return config_snapshot(taskmaster)
+    if command == ["stats"]:
+        return show_stats()
+    if command == ["stats", "--json"]:
+        return stats_snapshot()
+    if len(command) == 1 and command[0] in ["shutdown", "reload", "list"]:
         action = command[0]
     elif len(command) == 1:
         logger.info(
@@ -55,8 +374,6 @@ async def handle_command(
             return task.stop()
         case "restart":
             return task.restart()
-        case "status":
-            return show_status(taskmaster.programs, return_string)
         case "reload":
             return await reload_config_file(taskmaster)
         case "shutdown":
@@ -69,11 +386,5 @@ async def handle_command(
             logger.info(f"Log level set to {log_level}")
             return f"Log level set to {log_level}"
         case _:
-            logger.info(
-                f"Unknown command: `{action}` (Available commands: "
-                "start, stop, restart, reload, status, exit)"
-            )
-            return (
-                f"Unknown command: `{action}` (Available commands: "
-                "start, stop, restart, reload, status, exit)"
-            )
+            logger.info(f"Unknown command: `{action}` ({AVAILABLE_COMMANDS})")
+            return f"Unknown command: `{action}` ({AVAILABLE_COMMANDS})"
@@ -1,12 +1,45 @@
+import asyncio
 import logging
 import argparse
+import glob
+import hashlib
+import json
+import os
+import time
 import yaml
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import fields
 from exceptions import ConfigError
-from typing import Dict
-from enums import Signal, AutoRestart
+from typing import Dict, List, Tuple
+from enums import SIGNAL_MAP, Signal, AutoRestart
 from exceptions import ProgramDefinitionError
-from definitions import ProgramDefinition
+from definitions import (
+    AlertSink,
+    BackoffPolicy,
+    ProgramDefinition,
+    TaskMasterDefinition,
+    rolling_batch_size,
+)
+from dependencies import startup_layers
+from capture import (
+    DEFAULT_LOG_DIRECTORY,
+    DEFAULT_LOGFILE_BACKUPS,
+    DEFAULT_LOGFILE_MAXBYTES,
+)
+from log_queue import (
+    DEFAULT_LOG_QUEUE_SIZE,
+    DEFAULT_OVERFLOW_POLICY,
+    OVERFLOW_POLICIES,
+)
+from reaper import DEFAULT_SUPERVISION_ENGINE, SUPERVISION_ENGINES
+from sampler import DEFAULT_SAMPLE_INTERVAL
+from metrics import DEFAULT_METRICS_HOST, DEFAULT_METRICS_PORT
+from monitor import DEFAULT_SLOW_THRESHOLD
+from mail import DEFAULT_MAIL_DIGEST, DEFAULT_MAIL_QUEUE_SIZE
+from alerts import ALERT_EVENTS, SINK_TYPES, SYSLOG_FACILITIES
+from spawner import DEFAULT_SPAWN_CONCURRENCY, DEFAULT_SPAWN_RATE
+from watcher import DEFAULT_WATCH_DEBOUNCE, DEFAULT_WATCH_MODE, WATCH_MODES
 
 try:
     from yaml import CLoader as Loader
@@ -16,17 +49,358 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
-def config_file_parser(path: pathlib.Path) -> Dict:
-    if not path.exists() or path.is_dir():
-        raise ConfigError(
-            "The configuration `"
-            + str(path)
-            + "` file does not exist or is a directory."
+CONFIG_KEYS = ["programs", "taskmaster", "include"]
+PROGRAM_KEYS = [
+    "cmd",
+    "numprocs",
+    "umask",
+    "workingdir",
+    "autostart",
+    "autorestart",
+    "exitcodes",
+    "startretries",
+    "starttime",
+    "stopsignal",
+    "stoptime",
+    "stdout",
+    "stderr",
+    "stdout_logfile_maxbytes",
+    "stdout_logfile_backups",
+    "stderr_logfile_maxbytes",
+    "stderr_logfile_backups",
+    "env",
+    "mail_alerting",
+    "alerts",
+    "priority",
+    "depends_on",
+    "backoff",
+    "rolling_batch",
+]
+SETTINGS_KEYS = [
+    "spawn_concurrency",
+    "spawn_rate",
+    "logdir",
+    "log_queue_size",
+    "log_overflow",
+    "supervision",
+    "watch_config",
+    "watch_debounce",
+    "sample_interval",
+    "metrics_host",
+    "metrics_port",
+    "slow_threshold",
+    "mail_digest",
+    "mail_queue_size",
+]
+
+
+INCLUDE_WORKERS = 8
+
+
+def parse_yaml(path: pathlib.Path, content: bytes):
+    try:
+        return yaml.load(content, Loader=Loader)
+    except yaml.YAMLError as e:
+        raise ConfigError(f"Invalid YAML in `{path}`: {e}")
+
+
+def load_fragment(path: pathlib.Path) -> Tuple[int, int, str, dict]:
+    # runs in the include worker pool
+    try:
+        stat = path.stat()
+        with open(path, "rb") as file:
+            content = file.read()
+    except OSError as e:
+        raise ConfigError(f"Cannot read included `{path}`: {e}")
+    fragment = parse_yaml(path, content)
+    validate_fragment(path, fragment)
+    return (
+        stat.st_mtime_ns,
+        stat.st_size,
+        hashlib.sha256(content).hexdigest(),
+        fragment,
+    )
+
+
+class ConfigCache:
+    # The configuration is only parsed again when the sha256 of the file
+    # changes, and program definitions are only rebuilt when their own
+    # block changes, unchanged ones are reused as is. Included fragments
+    # are parsed in parallel, and only again when their mtime or size
+    # changes.
+
+    def __init__(self):
+        self.digest: str = None
+        self.applied_digest: str = None
+        self.config: dict = None
+        self.main_digest: str = None
+        self.main_config: dict = None
+        self.fragments: Dict[pathlib.Path, Tuple[int, int, str, dict]] = {}
+        self.parsed_fragments = 0
+        self.size = 0
+        self.parse_time = 0.0
+        self.definitions: Dict[str, Tuple[str, ProgramDefinition]] = {}
+        self.reused = 0
+        # a load updates the cache, so one at a time
+        self.lock = asyncio.Lock()
+
+    def load(self, path: pathlib.Path) -> dict:
+        if not path.exists() or path.is_dir():
+            raise ConfigError(
+                "The configuration `"
+                + str(path)
+                + "` file does not exist or is a directory."
+            )
+        started_at = time.monotonic()
+        with open(path, "rb") as file:
+            content = file.read()
+        main_digest = hashlib.sha256(content).hexdigest()
+        if main_digest == self.main_digest:
+            main_config = self.main_config
+        else:
+            main_config = parse_yaml(path, content)
+            validate_config(main_config)
+        fragments = self.load_fragments(expand_includes(path, main_config))
+        # the whole configuration is identified by the main file hash and
+        # the hash of every included fragment
+        digest = hashlib.sha256(
+            "".join(
+                [main_digest]
+                + [f"{path}:{fragments[path][2]}" for path in fragments]
+            ).encode()
+        ).hexdigest()
+        self.main_digest = main_digest
+        self.main_config = main_config
+        if digest == self.digest:
+            logger.debug(f"Configuration unchanged ({digest[:12]})")
+            return self.config
+        config = merge_fragments(main_config, fragments)
+        self.parse_time = time.monotonic() - started_at
+        self.config = config
+        self.digest = digest
+        self.size = len(content) + sum(
+            fragment[1] for fragment in fragments.values()
         )
-    with open(path) as file:
-        config = yaml.load(file, Loader=Loader)
-        logger.info("Configuration file parsed successfully.")
-    return config
+        logger.info(
+            f"Configuration file parsed successfully in "
+            f"{self.parse_time * 1000:.1f}ms ({digest[:12]}), "
+            f"{self.parsed_fragments}/{len(fragments)} fragments parsed"
+        )
+        return config
+
+    def load_fragments(
+        self, paths: List[pathlib.Path]
+    ) -> Dict[pathlib.Path, Tuple[int, int, str, dict]]:
+        fragments = {}
+        stale = []
+        for path in paths:
+            try:
+                stat = path.stat()
+            except OSError as e:
+                raise ConfigError(f"Cannot read included `{path}`: {e}")
+            cached = self.fragments.get(path)
+            if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+                fragments[path] = cached
+            else:
+                stale.append(path)
+        if stale:
+            with ThreadPoolExecutor(
+                max_workers=min(INCLUDE_WORKERS, len(stale))
+            ) as pool:
+                loaded = pool.map(load_fragment, stale)
+                for path, fragment in zip(stale, loaded):
+                    fragments[path] = fragment
+        self.parsed_fragments = len(stale)
+        # keep the include order, and forget the fragments no longer included
+        self.fragments = {path: fragments[path] for path in paths}
+        return self.fragments
+
+    def is_applied(self) -> bool:
+        return self.digest is not None and self.digest == self.applied_digest
+
+    def mark_applied(self):
+        self.applied_digest = self.digest
+
+    def get_definition(
+        self, program_name: str, block: dict
+    ) -> Tuple[str, ProgramDefinition]:
+        key = json.dumps(block, sort_keys=True, default=str)
+        cached = self.definitions.get(program_name)
+        if cached and cached[0] == key:
+            return key, cached[1]
+        return key, None
+
+    def get_stats(self) -> dict:
+        return {
+            "sha256": self.digest,
+            "applied": self.is_applied(),
+            "size": self.size,
+            "parse_time": round(self.parse_time, 6),
+            "fragments": len(self.fragments),
+            "parsed_fragments": self.parsed_fragments,
+            "programs": len(self.definitions),
+            "reused": self.reused,
+        }
+
+
+config_cache = ConfigCache()
+
+
+def validate_config(config) -> None:
+    if not isinstance(config, dict):
+        raise ConfigError("The configuration must be a mapping.")
+    errors = [
+        f"unknown key `{key}`" for key in config if key not in CONFIG_KEYS
+    ]
+    if not isinstance(config.get("programs") or {}, dict):
+        errors.append("`programs` must be a mapping of programs")
+    if not isinstance(config.get("include") or [], (str, list)):
+        errors.append("`include` must be a glob or a list of globs")
+    settings = config.get("taskmaster") or {}
+    if not isinstance(settings, dict):
+        errors.append("`taskmaster` must be a mapping")
+    else:
+        errors.extend(
+            f"taskmaster: unknown key `{key}`"
+            for key in settings
+            if key not in SETTINGS_KEYS
+        )
+    if errors:
+        raise ConfigError("Invalid configuration: " + ", ".join(errors))
+
+
+def validate_fragment(path: pathlib.Path, fragment) -> None:
+    # fragments only define programs
+    if not isinstance(fragment, dict) or set(fragment) - {"programs"}:
+        raise ConfigError(f"`{path}` must only contain `programs`")
+    if not isinstance(fragment.get("programs") or {}, dict):
+        raise ConfigError(f"`{path}`: `programs` must be a mapping")
+
+
+def expand_includes(path: pathlib.Path, config: dict) -> List[pathlib.Path]:
+    # globs are relative to the directory of the main configuration file
+    patterns = config.get("include") or []
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    paths = {}
+    for pattern in patterns:
+        pattern = os.path.join(path.parent, os.path.expanduser(str(pattern)))
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            logger.debug(f"No configuration file matches {pattern}")
+        for match in matches:
+            match = pathlib.Path(match).resolve()
+            if match != path.resolve() and match.is_file():
+                paths[match] = None
+    return list(paths)
+
+
+def merge_fragments(
+    config: dict, fragments: Dict[pathlib.Path, Tuple[int, int, str, dict]]
+) -> dict:
+    programs = dict(config.get("programs") or {})
+    errors = []
+    for path, (*_, fragment) in fragments.items():
+        for name, block in (fragment.get("programs") or {}).items():
+            if name in programs:
+                errors.append(f"{name} is defined twice (`{path}`)")
+            programs[name] = block
+    if errors:
+        raise ConfigError("Invalid configuration: " + ", ".join(errors))
+    return {**config, "programs": programs}
+
+
+async def config_file_parser(path: pathlib.Path) -> Dict:
+    # parsed in a worker thread, the event loop keeps supervising meanwhile
+    async with config_cache.lock:
+        return await asyncio.to_thread(config_cache.load, path)
+
+
+SIZE_UNITS = {"KB": 1024, "MB": 1024**2, "GB": 1024**3}
+
+
+def format_size(size) -> int:
+    # `1024`, `"64KB"`, `"50MB"` or `"1GB"`
+    size = str(size).strip().upper()
+    for unit, multiplier in SIZE_UNITS.items():
+        if size.endswith(unit):
+            return int(size[: -len(unit)]) * multiplier
+    return int(size)
+
+
+def format_depends_on(depends_on) -> tuple:
+    if isinstance(depends_on, str):
+        depends_on = [depends_on]
+    # keep order, drop duplicates
+    return tuple(dict.fromkeys(str(name) for name in depends_on))
+
+
+def format_backoff(backoff: dict) -> BackoffPolicy:
+    policy = BackoffPolicy(
+        **{key: float(value) for key, value in backoff.items()}
+    )
+    if policy.initial < 0 or policy.max < policy.initial:
+        raise ValueError("backoff: 0 <= initial <= max is required")
+    if policy.multiplier < 1 or not 0 <= policy.jitter <= 1:
+        raise ValueError("backoff: multiplier >= 1, 0 <= jitter <= 1")
+    return policy
+
+
+def format_alert_sink(alert: dict) -> AlertSink:
+    sink_type = str(alert.get("type", "")).lower()
+    if sink_type not in SINK_TYPES:
+        raise ValueError(
+            f"alerts: type must be one of {', '.join(SINK_TYPES)}"
+        )
+    target_key = SINK_TYPES[sink_type]
+    target = str(alert.get(target_key, "")) if target_key else ""
+    if sink_type == "syslog":
+        target = target.lower() or "user"
+        if target not in SYSLOG_FACILITIES:
+            raise ValueError(f"alerts: unknown syslog facility {target}")
+    elif target_key and not target:
+        raise ValueError(f"alerts: `{target_key}` is required for {sink_type}")
+    events = alert.get("events", ["ABORTED"])
+    if isinstance(events, str):
+        events = [events]
+    events = tuple(str(event).upper() for event in events)
+    unknown = [event for event in events if event not in ALERT_EVENTS]
+    if unknown:
+        raise ValueError(f"alerts: unknown events {', '.join(unknown)}")
+    sink = AlertSink(
+        type=sink_type,
+        target=target,
+        events=events,
+        rate=float(alert.get("rate", AlertSink.rate)),
+        retries=int(alert.get("retries", AlertSink.retries)),
+        timeout=float(alert.get("timeout", AlertSink.timeout)),
+    )
+    if sink.rate < 0 or sink.retries < 0 or sink.timeout <= 0:
+        raise ValueError("alerts: rate, retries and timeout must be positive")
+    return sink
+
+
+def format_alerts(alerts: list, mail_alerting: bool) -> tuple:
+    sinks = [format_alert_sink(alert) for alert in alerts]
+    if mail_alerting:
+        # historical shorthand for a mail on ABORTED
+        sinks.append(AlertSink(type="mail"))
+    # a sink listed twice would deliver every alert twice
+    return tuple(dict.fromkeys(sinks))
+
+
+def format_rolling_batch(batch, numprocs: int) -> str:
+    # validated here, sized against numprocs when the restart happens
+    if batch is None:
+        return None
+    rolling_batch_size(batch, numprocs)
+    return str(batch).strip()
+
+
+def format_exitcodes(exitcodes) -> tuple:
+    if isinstance(exitcodes, int):
+        exitcodes = [exitcodes]
+    return tuple(exitcodes)
 
 
 def format_env(env: dict) -> dict:
@@ -36,49 +410,312 @@ def format_env(env: dict) -> dict:
     return formatted
 
 
+BACKOFF_KEYS = [field.name for field in fields(BackoffPolicy)]
+# keys which may be left empty, `cmd` being reported as missing
+EMPTY_PROGRAM_KEYS = ["cmd", "alerts", "depends_on", "backoff", "rolling_batch"]
+
+
+def is_integer(value, minimum: int = None) -> bool:
+    # YAML booleans are ints for Python, never accepted as numbers
+    if isinstance(value, bool) or not isinstance(value, int):
+        return False
+    return minimum is None or value >= minimum
+
+
+def is_duration(value) -> bool:
+    return (
+        isinstance(value, (int, float))
+        and not isinstance(value, bool)
+        and value >= 0
+    )
+
+
+def is_umask(value) -> bool:
+    return isinstance(value, str) and 1 <= len(value) <= 4 and all(
+        digit in "01234567" for digit in value
+    )
+
+
+def is_exitcodes(value) -> bool:
+    codes = value if isinstance(value, list) else [value]
+    return bool(codes) and all(
+        is_integer(code, 0) and code <= 255 for code in codes
+    )
+
+
+def is_size(value) -> bool:
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return False
+    try:
+        return format_size(value) >= 0
+    except ValueError:
+        return False
+
+
+def is_names(value) -> bool:
+    names = value if isinstance(value, list) else [value]
+    return all(isinstance(name, str) and name for name in names)
+
+
+def is_backoff(value) -> bool:
+    return isinstance(value, dict) and all(
+        key in BACKOFF_KEYS and is_duration(number)
+        for key, number in value.items()
+    )
+
+
+# expected value of every program key, checked before anything is built
+PROGRAM_VALUE_CHECKS = {
+    "cmd": (lambda value: isinstance(value, str), "a string"),
+    "numprocs": (lambda value: is_integer(value, 1), "an integer >= 1"),
+    "umask": (is_umask, "an octal string such as `022`"),
+    "workingdir": (lambda value: isinstance(value, str), "a string"),
+    "autostart": (lambda value: isinstance(value, bool), "true or false"),
+    "autorestart": (
+        lambda value: value in [mode.value for mode in AutoRestart],
+        "unexpected, always or never",
+    ),
+    "exitcodes": (is_exitcodes, "an exit code or a list of exit codes"),
+    "startretries": (lambda value: is_integer(value, 0), "an integer >= 0"),
+    "starttime": (is_duration, "a number of seconds >= 0"),
+    "stopsignal": (
+        lambda value: value in SIGNAL_MAP,
+        f"one of {', '.join(SIGNAL_MAP)}",
+    ),
+    "stoptime": (is_duration, "a number of seconds >= 0"),
+    "stdout": (lambda value: isinstance(value, str), "a path"),
+    "stderr": (lambda value: isinstance(value, str), "a path"),
+    "stdout_logfile_maxbytes": (is_size, "a size such as `50MB`"),
+    "stdout_logfile_backups": (
+        lambda value: is_integer(value, 0),
+        "an integer >= 0",
+    ),
+    "stderr_logfile_maxbytes": (is_size, "a size such as `50MB`"),
+    "stderr_logfile_backups": (
+        lambda value: is_integer(value, 0),
+        "an integer >= 0",
+    ),
+    "env": (lambda value: isinstance(value, dict), "a mapping"),
+    "mail_alerting": (lambda value: isinstance(value, bool), "true or false"),
+    "alerts": (
+        lambda value: isinstance(value, list)
+        and all(isinstance(alert, dict) for alert in value),
+        "a list of alert sinks",
+    ),
+    "priority": (is_integer, "an integer"),
+    "depends_on": (is_names, "a program name or a list of program names"),
+    "backoff": (
+        is_backoff,
+        f"a mapping of numbers >= 0 among {', '.join(BACKOFF_KEYS)}",
+    ),
+    "rolling_batch": (
+        lambda value: is_integer(value) or isinstance(value, str),
+        "a number of processes or a percentage",
+    ),
+}
+
+
+def check_program_keys(prog: dict) -> List[str]:
+    errors = [
+        f"unknown key `{key}`" for key in prog if key not in PROGRAM_KEYS
+    ]
+    if not prog.get("cmd"):
+        errors.append("`cmd` is required")
+    # a wrong type would only fail once the program is launched
+    for key, (check, expected) in PROGRAM_VALUE_CHECKS.items():
+        if key not in prog:
+            continue
+        if prog[key] is None and key in EMPTY_PROGRAM_KEYS:
+            continue
+        if not check(prog[key]):
+            errors.append(f"`{key}` must be {expected}")
+    return errors
+
+
+def build_program_definition(
+    program_name: str, prog: dict
+) -> ProgramDefinition:
+    return ProgramDefinition(
+        name=program_name,
+        cmd=prog.get("cmd"),
+        numprocs=prog.get("numprocs", 1),
+        umask=int(prog.get("umask", "022"), 8),
+        cwd=prog.get("workingdir", "."),
+        autostart=prog.get("autostart", True),
+        autorestart=AutoRestart(
+            str(prog.get("autorestart", "unexpected")).lower()
+        ),
+        exitcodes=format_exitcodes(prog.get("exitcodes", [0])),
+        startretries=prog.get("startretries", 3),
+        starttime=prog.get("starttime", 0),
+        stopsignal=Signal(prog.get("stopsignal", "TERM")).signal,
+        stoptime=prog.get("stoptime", 10),
+        stdout=prog.get("stdout", "/dev/null"),
+        stderr=prog.get("stderr", "/dev/null"),
+        stdout_logfile_maxbytes=format_size(
+            prog.get("stdout_logfile_maxbytes", DEFAULT_LOGFILE_MAXBYTES)
+        ),
+        stdout_logfile_backups=int(
+            prog.get("stdout_logfile_backups", DEFAULT_LOGFILE_BACKUPS)
+        ),
+        stderr_logfile_maxbytes=format_size(
+            prog.get("stderr_logfile_maxbytes", DEFAULT_LOGFILE_MAXBYTES)
+        ),
+        stderr_logfile_backups=int(
+            prog.get("stderr_logfile_backups", DEFAULT_LOGFILE_BACKUPS)
+        ),
+        env=format_env(prog.get("env", {})),
+        mail_alerting=prog.get("mail_alerting", False),
+        alerts=format_alerts(
+            prog.get("alerts") or [], prog.get("mail_alerting", False)
+        ),
+        priority=int(prog.get("priority", 999)),
+        depends_on=format_depends_on(prog.get("depends_on") or []),
+        backoff=format_backoff(prog.get("backoff") or {}),
+        rolling_batch=format_rolling_batch(
+            prog.get("rolling_batch"), prog.get("numprocs", 1)
+        ),
+    )
+
+
 async def define_programs(
     config: dict,
 ) -> Dict[str, ProgramDefinition]:
     logger.debug("defining programs...")
     programs_definition: Dict[str, ProgramDefinition] = {}
-    program_list = config["programs"].keys()
-    for program_name in program_list:
-        prog = config["programs"][program_name]
-        try:
-            program = ProgramDefinition(
-                name=program_name,
-                cmd=prog.get("cmd"),
-                numprocs=prog.get("numprocs", 1),
-                umask=int(prog.get("umask", "022"), 8),
-                cwd=prog.get("workingdir", "."),
-                autostart=prog.get("autostart", True),
-                autorestart=AutoRestart(
-                    str(prog.get("autorestart", "unexpected")).lower()
-                ),
-                exitcodes=prog.get("exitcodes", [0]),
-                startretries=prog.get("startretries", 3),
-                starttime=prog.get("starttime", 0),
-                stopsignal=Signal(prog.get("stopsignal", "TERM")).signal,
-                stoptime=prog.get("stoptime", 10),
-                stdout=prog.get("stdout", "/dev/null"),
-                stderr=prog.get("stderr", "/dev/null"),
-                env=format_env(prog.get("env", {})),
-                mail_alerting=prog.get("mail_alerting", False),
-            )
-        except Exception as e:
-            logger.error("Error while parsing task definition.")
-            raise ProgramDefinitionError(
-                "Error while parsing task definition. "
-                "Check the configuration file: " + str(e)
-            )
+    definitions: Dict[str, Tuple[str, ProgramDefinition]] = {}
+    errors = []
+    reused = 0
+    # every program is checked in a single pass, all errors are reported
+    for program_name, prog in config["programs"].items():
+        if not isinstance(prog, dict):
+            errors.append(f"{program_name}: must be a mapping")
+            continue
+        key, program = config_cache.get_definition(program_name, prog)
+        if program is not None:
+            reused += 1
+        else:
+            program_errors = check_program_keys(prog)
+            if not program_errors:
+                try:
+                    program = build_program_definition(program_name, prog)
+                except Exception as e:
+                    program_errors.append(str(e))
+            if program_errors:
+                errors.extend(
+                    f"{program_name}: {error}" for error in program_errors
+                )
+                continue
         programs_definition[program_name] = program
-        if len(programs_definition) == 0:
-            raise ProgramDefinitionError(
-                "No program defined in the configuration file."
-            )
+        definitions[program_name] = (key, program)
+    if errors:
+        logger.error("Error while parsing task definition.")
+        raise ProgramDefinitionError(
+            "Error while parsing task definition. "
+            "Check the configuration file: " + "; ".join(errors)
+        )
+    if len(programs_definition) == 0:
+        raise ProgramDefinitionError(
+            "No program defined in the configuration file."
+        )
+    # raises on unknown dependencies and cycles
+    startup_layers(programs_definition)
+    config_cache.definitions = definitions
+    config_cache.reused = reused
+    logger.debug(
+        f"{len(programs_definition)} programs defined, {reused} unchanged"
+    )
     return programs_definition
 
 
+def define_settings(config: dict) -> TaskMasterDefinition:
+    logger.debug("defining taskmaster settings...")
+    settings = config.get("taskmaster") or {}
+    try:
+        taskmaster_settings = TaskMasterDefinition(
+            spawn_concurrency=int(
+                settings.get("spawn_concurrency", DEFAULT_SPAWN_CONCURRENCY)
+            ),
+            spawn_rate=float(settings.get("spawn_rate", DEFAULT_SPAWN_RATE)),
+            logdir=str(settings.get("logdir", DEFAULT_LOG_DIRECTORY)),
+            log_queue_size=int(
+                settings.get("log_queue_size", DEFAULT_LOG_QUEUE_SIZE)
+            ),
+            log_overflow=str(
+                settings.get("log_overflow", DEFAULT_OVERFLOW_POLICY)
+            ).lower(),
+            supervision=str(
+                settings.get("supervision", DEFAULT_SUPERVISION_ENGINE)
+            ).lower(),
+            watch_config=str(
+                settings.get("watch_config", DEFAULT_WATCH_MODE)
+            ).lower(),
+            watch_debounce=float(
+                settings.get("watch_debounce", DEFAULT_WATCH_DEBOUNCE)
+            ),
+            sample_interval=float(
+                settings.get("sample_interval", DEFAULT_SAMPLE_INTERVAL)
+            ),
+            metrics_host=str(
+                settings.get("metrics_host", DEFAULT_METRICS_HOST)
+            ),
+            metrics_port=int(
+                settings.get("metrics_port", DEFAULT_METRICS_PORT)
+            ),
+            slow_threshold=float(
+                settings.get("slow_threshold", DEFAULT_SLOW_THRESHOLD)
+            ),
+            mail_digest=float(
+                settings.get("mail_digest", DEFAULT_MAIL_DIGEST)
+            ),
+            mail_queue_size=int(
+                settings.get("mail_queue_size", DEFAULT_MAIL_QUEUE_SIZE)
+            ),
+        )
+    except Exception as e:
+        logger.error("Error while parsing taskmaster settings.")
+        raise ConfigError(
+            "Error while parsing taskmaster settings. "
+            "Check the configuration file: " + str(e)
+        )
+    if taskmaster_settings.spawn_concurrency < 1:
+        raise ConfigError("spawn_concurrency must be at least 1.")
+    if taskmaster_settings.spawn_rate < 0:
+        raise ConfigError("spawn_rate must be positive.")
+    if taskmaster_settings.log_overflow not in OVERFLOW_POLICIES:
+        raise ConfigError(
+            f"Invalid log_overflow: {taskmaster_settings.log_overflow}, "
+            f"valid policies: {', '.join(OVERFLOW_POLICIES)}"
+        )
+    if taskmaster_settings.supervision not in SUPERVISION_ENGINES:
+        raise ConfigError(
+            f"Invalid supervision: {taskmaster_settings.supervision}, "
+            f"valid engines: {', '.join(SUPERVISION_ENGINES)}"
+        )
+    if taskmaster_settings.watch_config not in WATCH_MODES:
+        raise ConfigError(
+            f"Invalid watch_config: {taskmaster_settings.watch_config}, "
+            f"valid modes: {', '.join(WATCH_MODES)}"
+        )
+    if taskmaster_settings.watch_debounce < 0:
+        raise ConfigError("watch_debounce must be positive.")
+    if taskmaster_settings.sample_interval < 0:
+        raise ConfigError("sample_interval must be positive.")
+    if not 0 <= taskmaster_settings.metrics_port <= 65535:
+        raise ConfigError("metrics_port must be a port number, or 0.")
+    if taskmaster_settings.slow_threshold < 0:
+        raise ConfigError("slow_threshold must be positive.")
+    if taskmaster_settings.mail_digest < 0:
+        raise ConfigError("mail_digest must be positive.")
+    if taskmaster_settings.mail_queue_size < 1:
+        raise ConfigError("mail_queue_size must be at least 1.")
+    if not pathlib.Path(taskmaster_settings.logdir).is_dir():
+        raise ConfigError(
+            f"logdir `{taskmaster_settings.logdir}` is not a directory."
+        )
+    return taskmaster_settings
+
+
 def parse_arguments() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Process taskmaster options.")
     parser.add_argument(
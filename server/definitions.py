@@ -1,10 +1,35 @@
+import math
 from dataclasses import dataclass
-from typing import List
+from typing import Tuple
 from enums import AutoRestart
 
 
-@dataclass
+@dataclass(frozen=True)
+class BackoffPolicy:
+    initial: float = 1
+    max: float = 60
+    multiplier: float = 2
+    jitter: float = 0.1
+    crashloop_window: float = 60
+    crashloop_max: int = 5
+    healthy_time: float = 60
+
+
+@dataclass(frozen=True)
+class AlertSink:
+    # where alerts go: a mail, a webhook url, a command or a syslog facility
+    type: str
+    target: str = ""
+    events: Tuple[str, ...] = ("ABORTED",)
+    rate: float = 60  # alerts per minute, 0 for unlimited
+    retries: int = 3
+    timeout: float = 10
+
+
+@dataclass(frozen=True, slots=True)
 class ProgramDefinition:
+    # Shared by a program and all its processes, and by the config cache
+    # across reloads: never modified, a reload swaps it for a new one
     name: str
     cmd: str
     umask: int
@@ -12,12 +37,53 @@ class ProgramDefinition:
     cwd: str
     autostart: bool
     autorestart: AutoRestart
-    exitcodes: List[int]
+    exitcodes: Tuple[int, ...]
     startretries: int
     starttime: int
     stopsignal: str
     stoptime: int
     stdout: str
     stderr: str
+    stdout_logfile_maxbytes: int
+    stdout_logfile_backups: int
+    stderr_logfile_maxbytes: int
+    stderr_logfile_backups: int
     env: dict
     mail_alerting: bool
+    alerts: Tuple[AlertSink, ...]
+    priority: int
+    depends_on: Tuple[str, ...]
+    backoff: BackoffPolicy
+    rolling_batch: str
+
+
+@dataclass
+class TaskMasterDefinition:
+    spawn_concurrency: int
+    spawn_rate: float
+    logdir: str
+    log_queue_size: int
+    log_overflow: str
+    supervision: str
+    watch_config: str
+    watch_debounce: float
+    sample_interval: float
+    metrics_host: str
+    metrics_port: int
+    slow_threshold: float
+    mail_digest: float
+    mail_queue_size: int
+
+
+def rolling_batch_size(batch, numprocs: int) -> int:
+    # `4` processes at a time, or `25%` of numprocs (at least one)
+    batch = str(batch).strip()
+    if batch.endswith("%"):
+        percent = float(batch[:-1])
+        if not 0 < percent <= 100:
+            raise ValueError(f"Invalid rolling batch: {batch}")
+        return max(1, math.ceil(numprocs * percent / 100))
+    size = int(batch)
+    if size < 1:
+        raise ValueError(f"Invalid rolling batch: {batch}")
+    return size
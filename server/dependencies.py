@@ -0,0 +1,42 @@
+import logging
+from typing import Dict, List
+from definitions import ProgramDefinition
+from exceptions import ProgramDefinitionError
+
+logger = logging.getLogger(__name__)
+
+
+def startup_layers(
+    programs_definition: Dict[str, ProgramDefinition],
+) -> List[List[str]]:
+    # Kahn's algorithm: each layer only depends on the previous ones, so
+    # programs of the same layer can be started (or stopped) in parallel
+    dependents: Dict[str, List[str]] = {name: [] for name in programs_definition}
+    remaining: Dict[str, int] = {}
+    for name, definition in programs_definition.items():
+        for dependency in definition.depends_on:
+            if dependency not in programs_definition:
+                raise ProgramDefinitionError(
+                    f"Program {name} depends on unknown program {dependency}"
+                )
+            dependents[dependency].append(name)
+        remaining[name] = len(definition.depends_on)
+
+    layers = []
+    layer = [name for name, count in remaining.items() if count == 0]
+    while layer:
+        layers.append(layer)
+        next_layer = []
+        for name in layer:
+            for dependent in dependents[name]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    next_layer.append(dependent)
+        layer = next_layer
+
+    if sum(len(layer) for layer in layers) != len(programs_definition):
+        cycle = [name for name, count in remaining.items() if count > 0]
+        raise ProgramDefinitionError(
+            f"Circular dependency between programs: {', '.join(cycle)}"
+        )
+    return layers
@@ -28,6 +28,7 @@ class Status(str, Enum):
     FATAL = "FATAL"
     STOPPING = "STOPPING"
     ABORTED = "ABORTED"
+    BACKOFF = "BACKOFF"
 
     def __str__(self):
         return self.value
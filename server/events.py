@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_QUEUE_SIZE = 1024
+REMOVED_HISTORY_SIZE = 4096
+
+
+@dataclass
+class Event:
+    program: str
+    process: str
+    old_state: str
+    state: str
+    pid: int = None
+    returncode: int = None
+    retries: int = 0
+    version: int = 0
+    timestamp: float = field(default_factory=time.time)
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+    def __str__(self):
+        return (
+            f"{self.process}: {self.old_state} -> {self.state}"
+            f" (pid {self.pid}, returncode {self.returncode},"
+            f" retries {self.retries})"
+        )
+
+
+@dataclass(eq=False)
+class Subscriber:
+    programs: Set[str] = field(default_factory=set)
+    states: Set[str] = field(default_factory=set)
+    queue: asyncio.Queue = None
+    dropped: int = 0
+
+    def __post_init__(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def matches(self, event: Event) -> bool:
+        if self.programs and event.program not in self.programs:
+            return False
+        if self.states and event.state not in self.states:
+            return False
+        return True
+
+    def push(self, event: Event):
+        # never block the publisher: a full queue loses its oldest event
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    def take_dropped(self) -> int:
+        dropped, self.dropped = self.dropped, 0
+        return dropped
+
+
+class EventBus:
+    def __init__(self):
+        self.subscribers: Set[Subscriber] = set()
+        # Every state change bumps a monotonically increasing version
+        self.version = 0
+        # Processes ordered by their last change, most recent last
+        self.changes: OrderedDict = OrderedDict()
+        # (version, process name) of removed processes
+        self.removed = deque(maxlen=REMOVED_HISTORY_SIZE)
+        self.removed_floor = 0
+
+    def next_version(self) -> int:
+        self.version += 1
+        return self.version
+
+    def record_change(self, process) -> int:
+        process.version = self.next_version()
+        self.changes[process.name] = process
+        self.changes.move_to_end(process.name)
+        return process.version
+
+    def record_removal(self, process_name: str):
+        self.changes.pop(process_name, None)
+        if len(self.removed) == self.removed.maxlen:
+            self.removed_floor = self.removed[0][0]
+        self.removed.append((self.next_version(), process_name))
+
+    def changed_since(self, version: int) -> list:
+        # walks back from the most recent change: O(changes)
+        changed = []
+        for process in reversed(self.changes.values()):
+            if process.version <= version:
+                break
+            changed.append(process)
+        changed.reverse()
+        return changed
+
+    def removed_since(self, version: int) -> Optional[List[str]]:
+        # None when the history no longer covers `version`, or when it
+        # is ahead of the server (kept across a restart): the caller then
+        # needs a full snapshot
+        if version < self.removed_floor or version > self.version:
+            return None
+        return [
+            name for removed_at, name in self.removed if removed_at > version
+        ]
+
+    def subscribe(
+        self, programs: Set[str] = None, states: Set[str] = None
+    ) -> Subscriber:
+        subscriber = Subscriber(
+            programs=set(programs or ()), states=set(states or ())
+        )
+        self.subscribers.add(subscriber)
+        logger.debug(f"New subscriber, {len(self.subscribers)} subscribed")
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+        logger.debug(f"Subscriber left, {len(self.subscribers)} subscribed")
+
+    def publish(self, event: Event):
+        for subscriber in self.subscribers:
+            if subscriber.matches(event):
+                subscriber.push(event)
+
+
+event_bus = EventBus()
@@ -0,0 +1,126 @@
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOG_QUEUE_SIZE = 10000
+OVERFLOW_POLICIES = ["drop_debug", "drop_new", "block"]
+DEFAULT_OVERFLOW_POLICY = "drop_debug"
+
+
+class OverflowQueue(queue.Queue):
+    # Queue of log records which never blocks the event loop when full
+    # (unless the policy is `block`):
+    # - drop_debug: evict the oldest record of the lowest level below the
+    #   new record level (DEBUG first), drop the new record otherwise
+    # - drop_new: drop the new record
+
+    def __init__(
+        self,
+        maxsize: int = DEFAULT_LOG_QUEUE_SIZE,
+        policy: str = DEFAULT_OVERFLOW_POLICY,
+    ):
+        super().__init__(maxsize)
+        self.policy = policy
+        self.dropped = 0
+
+    def put_nowait(self, record: logging.LogRecord):
+        # None is the listener stop sentinel
+        if self.policy == "block" or record is None:
+            return self.put(record)
+        with self.not_full:
+            if self.maxsize > 0 and self._qsize() >= self.maxsize:
+                if not self.evict_lower_than(record.levelno):
+                    self.dropped += 1
+                    return
+            self._put(record)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def evict_lower_than(self, levelno: int) -> bool:
+        victim = None
+        for queued in self.queue:
+            if queued is None or queued.levelno >= levelno:
+                continue
+            if victim is None or queued.levelno < victim.levelno:
+                victim = queued
+                if victim.levelno <= logging.DEBUG:
+                    break
+        if victim is None:
+            return False
+        self.queue.remove(victim)
+        self.unfinished_tasks -= 1
+        self.dropped += 1
+        return True
+
+    def take_dropped(self) -> int:
+        with self.mutex:
+            dropped, self.dropped = self.dropped, 0
+        return dropped
+
+
+class BufferedFileHandler(logging.FileHandler):
+    # Writes go to the file buffer, the listener flushes them in batches
+    def emit(self, record: logging.LogRecord):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class BatchingQueueListener(QueueListener):
+    # Runs the handlers in a background thread and only flushes them once
+    # the queue is drained, so a burst of records is written at once
+    def handle(self, record: logging.LogRecord):
+        super().handle(record)
+        if self.queue.empty():
+            dropped = self.queue.take_dropped()
+            if dropped:
+                super().handle(
+                    logger.makeRecord(
+                        logger.name,
+                        logging.WARNING,
+                        __file__,
+                        0,
+                        f"Log queue full: {dropped} records dropped",
+                        None,
+                        None,
+                    )
+                )
+            for handler in self.handlers:
+                handler.flush()
+
+
+log_queue = OverflowQueue()
+listener: BatchingQueueListener = None
+
+
+def start_logging(*handlers: logging.Handler):
+    global listener
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(QueueHandler(log_queue))
+    listener = BatchingQueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    listener.start()
+
+
+def configure(size: int, policy: str):
+    logger.debug(f"Log queue: size {size}, overflow policy {policy}")
+    with log_queue.mutex:
+        log_queue.maxsize = size
+        log_queue.policy = policy
+
+
+def stop_logging():
+    if listener:
+        listener.stop()
+
+
+def get_stats() -> dict:
+    return {"queued": log_queue.qsize(), "size": log_queue.maxsize}
@@ -1,34 +1,198 @@
+import asyncio
 import os
 import smtplib
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
+from typing import Dict, Tuple
 from dotenv import load_dotenv
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+DEFAULT_MAIL_DIGEST = 30.0  # seconds of alerts gathered in one mail
+DEFAULT_MAIL_QUEUE_SIZE = 1000
+MAIL_TIMEOUT = 30  # seconds, SMTP connection and commands
+FLUSH_TIMEOUT = 10  # seconds to send pending alerts on shutdown
 
-def email_alert(subject: str, body: str):
 
-    user = os.getenv("EMAIL_USERNAME")
-    password = os.getenv("EMAIL_PASSWORD")
-    host = os.getenv("EMAIL_HOST")
-    port = os.getenv("EMAIL_PORT")
-    dests = os.getenv("EMAIL_DESTS")
+def mail_settings() -> dict:
+    # read at send time, so the .env can be fixed without a restart
+    return {
+        "user": os.getenv("EMAIL_USERNAME"),
+        "password": os.getenv("EMAIL_PASSWORD"),
+        "host": os.getenv("EMAIL_HOST"),
+        "port": int(os.getenv("EMAIL_PORT") or 465),
+        "dests": os.getenv("EMAIL_DESTS"),
+        # plain SMTP to test against a local server
+        "ssl": os.getenv("EMAIL_SSL", "true").lower() not in ["0", "false"],
+    }
+
 
+def build_message(subject: str, body: str, settings: dict) -> EmailMessage:
     msg = EmailMessage()
     msg.set_content(body)
     msg["subject"] = subject
-    msg["from"] = user
-    msg["to"] = dests
+    msg["from"] = settings["user"]
+    msg["to"] = settings["dests"]
+    return msg
+
+
+def email_alert(subject: str, body: str):
+    # blocking, one connection per mail
+    settings = mail_settings()
+    msg = build_message(subject, body, settings)
+    logger.debug(f"Sending email to {settings['dests']}")
+    with connect(settings) as smtp_server:
+        smtp_server.send_message(msg)
+        logger.debug("Email sent successfully")
+
+
+def connect(settings: dict) -> smtplib.SMTP:
+    smtp_class = smtplib.SMTP_SSL if settings["ssl"] else smtplib.SMTP
+    smtp_server = smtp_class(
+        settings["host"], settings["port"], timeout=MAIL_TIMEOUT
+    )
+    if settings["user"] and settings["password"]:
+        smtp_server.login(settings["user"], settings["password"])
+    return smtp_server
+
+
+class MailDispatcher:
+    # Alerts are queued without blocking the event loop and sent by a single
+    # mail thread, which keeps its SMTP connection open between mails.
+    # Alerts raised during `digest` seconds are sent in one mail, identical
+    # alerts (same subject and body) being listed once with their count.
+
+    def __init__(self):
+        self.digest = DEFAULT_MAIL_DIGEST
+        self.queue_size = DEFAULT_MAIL_QUEUE_SIZE
+        # alerts waiting for the next digest, with their count
+        self.queue: Dict[Tuple[str, str], int] = {}
+        self.wakeup: asyncio.Event = None
+        self.task: asyncio.Task = None
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="mail"
+        )
+        self.smtp_server: smtplib.SMTP = None
+        self.queued = 0
+        self.deduplicated = 0
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
 
-    logger.debug(f"Sending email to {dests}")
-    with smtplib.SMTP_SSL(host, port) as smtp_server:
-        smtp_server.login(user, password)
-        smtp_server.sendmail(user, dests, msg.as_string())
+    def configure(self, digest: float, queue_size: int):
+        logger.debug(f"Mail alerts: digest {digest}s, queue size {queue_size}")
+        self.digest = digest
+        self.queue_size = queue_size
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+
+    def alert(self, subject: str, body: str):
+        # never blocks, the alert is sent by the dispatcher task
+        alert = (subject, body)
+        if alert in self.queue:
+            self.queue[alert] += 1
+            self.deduplicated += 1
+        elif len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            logger.warning(f"Mail queue full, alert dropped: {subject}")
+            return
+        else:
+            self.queue[alert] = 1
+        self.queued += 1
+        if self.wakeup:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            # everything raised meanwhile joins this mail
+            await asyncio.sleep(self.digest)
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        pending, self.queue = self.queue, {}
+        if not pending:
+            return
+        subject, body = digest_message(pending)
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.send, subject, body
+            )
+            self.sent += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Error sending email alert: {e}")
+
+    def send(self, subject: str, body: str):
+        # runs in the mail thread, the only user of the connection
+        settings = mail_settings()
+        msg = build_message(subject, body, settings)
+        logger.debug(f"Sending email to {settings['dests']}")
+        try:
+            if self.smtp_server is None:
+                self.smtp_server = connect(settings)
+            self.smtp_server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # closed by the server since the previous mail, retried once
+            self.smtp_server = connect(settings)
+            self.smtp_server.send_message(msg)
+        except Exception:
+            self.close_connection()
+            raise
         logger.debug("Email sent successfully")
 
+    def close_connection(self):
+        if self.smtp_server:
+            try:
+                self.smtp_server.quit()
+            except Exception:
+                pass
+            self.smtp_server = None
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        try:
+            await asyncio.wait_for(self.flush(), FLUSH_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("Pending email alerts could not be sent in time")
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.close_connection
+        )
+
+    def get_stats(self) -> dict:
+        return {
+            "queued": len(self.queue),
+            "digest": self.digest,
+            "alerts": self.queued,
+            "deduplicated": self.deduplicated,
+            "dropped": self.dropped,
+            "sent": self.sent,
+            "failed": self.failed,
+        }
+
+
+def digest_message(pending: Dict[Tuple[str, str], int]) -> Tuple[str, str]:
+    if len(pending) == 1:
+        (subject, body), count = next(iter(pending.items()))
+        if count > 1:
+            body += f"\n(raised {count} times)"
+        return subject, body
+    lines = [f"{len(pending)} alerts:", ""]
+    for (subject, body), count in pending.items():
+        repeated = f" (x{count})" if count > 1 else ""
+        lines.append(f"- {subject}{repeated}: {body}")
+    return f"Taskmaster: {len(pending)} alerts", "\n".join(lines)
+
+
+mailer = MailDispatcher()
+
 
 if __name__ == "__main__":
 
-    email_alert("DEV", "Hello from app", "victor.chevillotte@gmail.com")
+    email_alert("DEV", "Hello from app")
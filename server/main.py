@@ -3,42 +3,108 @@ import logging
 import pathlib
 import signal
 from config_parser import (
+    config_cache,
     config_file_parser,
     parse_arguments,
     define_programs,
+    define_settings,
 )
 from functools import partial
-from command_handler import handle_command
-from actions import launch_programs, reload_config_file, shutdown
+from command_handler import handle_command, handle_stream, is_streaming_command
+from actions import (
+    apply_settings,
+    launch_programs,
+    reload_config_file,
+    shutdown,
+)
 from taskmaster import TaskMaster
+from protocol import (
+    FRAME_SEPARATOR,
+    MAX_FRAME_SIZE,
+    MAX_INFLIGHT_REQUESTS,
+    MAX_STREAMS,
+    Request,
+    decode_frame,
+    encode_error,
+    encode_event,
+    encode_response,
+)
 import os
 import pwd
+from log_queue import BufferedFileHandler, start_logging, stop_logging
 
 try:
     root_logger = logging.getLogger()
     logger = logging.getLogger("main")
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format="%(levelname)-8s: %(name)-8s: %(message)-8s",
+    root_logger.setLevel(logging.DEBUG)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(
+        logging.Formatter("%(levelname)-8s: %(name)-8s: %(message)-8s")
     )
-    file_handler = logging.FileHandler("./logs/taskmaster.log")
+    file_handler = BufferedFileHandler("./logs/taskmaster.log")
     file_handler.setLevel(logging.DEBUG)
     file_formatter = logging.Formatter(
         "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     )
     file_handler.setFormatter(file_formatter)
-    root_logger.addHandler(file_handler)
+    # handlers run in a background thread, fed through a queue
+    start_logging(console_handler, file_handler)
 except Exception as e:
+    logging.basicConfig()
     logging.error(f"Logger configuration error: {e}")
     exit(1)
 
 
 async def launch_taskmaster(taskmaster: TaskMaster):
-    config = config_file_parser(taskmaster.config_file)
+    config = await config_file_parser(taskmaster.config_file)
+    apply_settings(taskmaster, define_settings(config))
     taskmaster.programs_definition = await define_programs(config)
+    config_cache.mark_applied()
     await launch_programs(taskmaster.programs_definition, taskmaster.programs)
 
 
+async def handle_request(
+    request: Request,
+    writer: asyncio.StreamWriter,
+    taskmaster: TaskMaster,
+):
+    try:
+        response = await handle_command(
+            request.command, taskmaster, root_logger
+        )
+        if response:
+            logger.debug(f"Sending: {response}")
+            writer.write(encode_response(request, response))
+            await writer.drain()
+    except ConnectionError as e:
+        logger.debug(f"Could not send response to {request.id}: {e}")
+    except Exception as e:
+        logger.error(f"An error occurred handling `{request.command}`: {e}")
+        if not writer.is_closing():
+            writer.write(encode_error(request, str(e)))
+            await writer.drain()
+
+
+async def handle_stream_request(
+    request: Request,
+    writer: asyncio.StreamWriter,
+    taskmaster: TaskMaster,
+):
+    async def send(message):
+        if isinstance(message, str):
+            writer.write(encode_response(request, message))
+        else:
+            writer.write(encode_event(request, message))
+        await writer.drain()
+
+    try:
+        await handle_stream(request.command, taskmaster, send)
+    except ConnectionError as e:
+        logger.debug(f"Stream {request.id} closed: {e}")
+    except Exception as e:
+        logger.error(f"An error occurred streaming `{request.command}`: {e}")
+
+
 async def handle_client(
     reader: asyncio.StreamReader,
     writer: asyncio.StreamWriter,
@@ -47,29 +113,76 @@ async def handle_client(
     addr = writer.get_extra_info("peername")
     logger.info(f"Client {addr} connected")
     taskmaster.active_connections[addr] = writer
+    inflight = asyncio.Semaphore(MAX_INFLIGHT_REQUESTS)
+    pending = set()
+    streams = set()
+
+    def request_done(task: asyncio.Task):
+        pending.discard(task)
+        inflight.release()
+
+    def stream_done(task: asyncio.Task):
+        streams.discard(task)
+        taskmaster.active_streams -= 1
 
     try:
         while True:
-            data = await reader.read(4096)
-            if not data:
+            try:
+                frame = await reader.readuntil(FRAME_SEPARATOR)
+            except asyncio.IncompleteReadError as e:
+                # last frame may not be terminated by a separator
+                frame = e.partial
+                if not frame:
+                    break
+            except asyncio.LimitOverrunError:
+                logger.info(f"Client {addr} sent a frame that is too long")
+                writer.write(b"Frame too long\n")
                 break
-            message = data.decode()
-            logger.debug(f"Received: {message}")
-            response = await handle_command(message, taskmaster, root_logger)
-            if response:
-                logger.debug(f"Sending: {response}")
-                # if response does not end with \n, add it
-                if not response.endswith("\n"):
-                    response = response + "\n"
-                writer.write(response.encode())
-                await writer.drain()
+            request = decode_frame(frame)
+            if not request.command:
+                continue
+            logger.debug(f"Received: {request}")
+            if is_streaming_command(request.command):
+                if taskmaster.active_streams >= MAX_STREAMS:
+                    logger.warning(
+                        f"Client {addr}: `{request.command}` refused, "
+                        f"{MAX_STREAMS} streams already open"
+                    )
+                    writer.write(
+                        encode_error(
+                            request, f"Too many streams open ({MAX_STREAMS})"
+                        )
+                    )
+                    continue
+                # streams last until the client disconnects
+                taskmaster.active_streams += 1
+                stream = asyncio.create_task(
+                    handle_stream_request(request, writer, taskmaster)
+                )
+                streams.add(stream)
+                stream.add_done_callback(stream_done)
+                continue
+            # backpressure: stop reading frames while too many are in flight
+            await inflight.acquire()
+            task = asyncio.create_task(
+                handle_request(request, writer, taskmaster)
+            )
+            pending.add(task)
+            task.add_done_callback(request_done)
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
     except Exception as e:
         logger.error(f"An error occurred: {e}")
     finally:
+        for stream in list(streams):
+            stream.cancel()
         logger.info(f"Client {addr} disconnected")
         writer.close()
-        await writer.wait_closed()
-        taskmaster.active_connections.pop(addr)
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+        taskmaster.active_connections.pop(addr, None)
 
 
 def drop_privileges():
@@ -108,6 +221,7 @@ async def main():
         partial(handle_client, taskmaster=taskmaster),
         "127.0.0.1",
         port,
+        limit=MAX_FRAME_SIZE,
     )
 
     addr = taskmaster.server.sockets[0].getsockname()
@@ -143,3 +257,5 @@ try:
     asyncio.run(main())
 except KeyboardInterrupt:
     logger.info("Server stopped manually")
+finally:
+    stop_logging()
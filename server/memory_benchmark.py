@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import gc
+import tracemalloc
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, List, Tuple
+
+from config_parser import build_program_definition
+from definitions import AlertSink, BackoffPolicy, ProgramDefinition
+from enums import AutoRestart, Signal, Status
+from program import Program
+
+# Memory used by the supervision state of a large program, without
+# spawning anything: python server/memory_benchmark.py -n 10000
+# Measured for the current processes, sharing the frozen definition of
+# their program, and for the previous layout, where every process was a
+# plain dataclass holding its own copy of the definition fields.
+
+
+@dataclass
+class BaselineProcess:
+    # the Process layout before definitions were shared
+    name: str
+    cmd: str
+    cwd: str
+    env: dict
+    umask: int
+    stdout: str
+    stderr: str
+    stdout_logfile_maxbytes: int
+    stdout_logfile_backups: int
+    stderr_logfile_maxbytes: int
+    stderr_logfile_backups: int
+    autorestart: AutoRestart
+    exitcodes: List[int]
+    startretries: int
+    starttime: int
+    stoptime: int
+    status: Status = Status.STOPPED
+    process: asyncio.subprocess.Process = None
+    stopsignal: Signal = None
+    returncode: int = None
+    retries: int = 0
+    started_at: int = 0
+    stopped_at: int = 0
+    mail_alerting: bool = False
+    alerts: Tuple[AlertSink, ...] = ()
+    stdout_reader_task: asyncio.Task = None
+    stderr_reader_task: asyncio.Task = None
+    start_timer: object = None
+    stop_timer: object = None
+    program_name: str = ""
+    version: int = 0
+    priority: int = 999
+    spawn_slot: bool = False
+    stdout_log: object = None
+    stderr_log: object = None
+    backoff: BackoffPolicy = field(default_factory=BackoffPolicy)
+    backoff_delay: float = 0
+    crash_times: deque = field(default_factory=deque)
+    retry_timer: object = None
+
+
+def build_definition(numprocs: int, env_size: int) -> ProgramDefinition:
+    return build_program_definition(
+        "bench",
+        {
+            "cmd": "/bin/sleep 1000",
+            "numprocs": numprocs,
+            "env": {f"VARIABLE_{index}": "x" * 32 for index in range(env_size)},
+            "exitcodes": [0, 2],
+            "alerts": [{"type": "syslog"}],
+        },
+    )
+
+
+def build_program(definition: ProgramDefinition) -> Program:
+    program = Program(definition)
+    for process_id in range(definition.numprocs):
+        program.processes[process_id] = program.new_process(process_id)
+    return program
+
+
+def build_baseline_program(definition: ProgramDefinition) -> dict:
+    # fields were copied from the program into every process
+    return {
+        process_id: BaselineProcess(
+            name=f"{definition.name}-{process_id}",
+            program_name=definition.name,
+            priority=definition.priority,
+            backoff=definition.backoff,
+            cmd=definition.cmd,
+            cwd=definition.cwd,
+            env=definition.env,
+            umask=definition.umask,
+            stdout=definition.stdout,
+            stderr=definition.stderr,
+            stdout_logfile_maxbytes=definition.stdout_logfile_maxbytes,
+            stdout_logfile_backups=definition.stdout_logfile_backups,
+            stderr_logfile_maxbytes=definition.stderr_logfile_maxbytes,
+            stderr_logfile_backups=definition.stderr_logfile_backups,
+            exitcodes=definition.exitcodes,
+            stopsignal=definition.stopsignal,
+            starttime=definition.starttime,
+            stoptime=definition.stoptime,
+            autorestart=definition.autorestart,
+            startretries=definition.startretries,
+            mail_alerting=definition.mail_alerting,
+            alerts=definition.alerts,
+        )
+        for process_id in range(definition.numprocs)
+    }
+
+
+def measure(build: Callable, definition: ProgramDefinition) -> int:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    program = build(definition)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del program
+    return used
+
+
+def report(label: str, used: int, numprocs: int):
+    print(
+        f"{label}: {numprocs} processes: {used / 1024 / 1024:.2f}MB, "
+        f"{used / numprocs:.0f} bytes per process"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--numprocs", type=int, default=10000)
+    parser.add_argument("-e", "--env-size", type=int, default=20)
+    args = parser.parse_args()
+    definition = build_definition(args.numprocs, args.env_size)
+    baseline = measure(build_baseline_program, definition)
+    current = measure(build_program, definition)
+    report("baseline", baseline, args.numprocs)
+    report("shared definition", current, args.numprocs)
+    print(f"saved: {(1 - current / baseline) * 100:.0f}%")
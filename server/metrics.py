@@ -0,0 +1,239 @@
+import asyncio
+import logging
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from events import event_bus
+from monitor import Histogram, monitor
+from sampler import sampler
+from spawner import spawner
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_HOST = "127.0.0.1"
+DEFAULT_METRICS_PORT = 0  # disabled
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+MAX_REQUEST_SIZE = 8 * 1024  # bytes of request line and headers
+
+# families of the per process samples, in rendering order
+PROCESS_FAMILIES = [
+    ("taskmaster_process_state", "gauge", "Current state of the process"),
+    ("taskmaster_process_retries", "gauge", "Retries since the last start"),
+    (
+        "taskmaster_process_exit_code",
+        "gauge",
+        "Return code of the last exit",
+    ),
+    (
+        "taskmaster_process_start_time_seconds",
+        "gauge",
+        "Start time of the process since the epoch",
+    ),
+    ("taskmaster_process_cpu_percent", "gauge", "CPU usage of the process"),
+    (
+        "taskmaster_process_resident_memory_bytes",
+        "gauge",
+        "Resident memory of the process",
+    ),
+    ("taskmaster_process_open_fds", "gauge", "Open file descriptors"),
+]
+
+
+def escape(value: str) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def process_lines(process) -> Tuple[str, ...]:
+    labels = (
+        f'program="{escape(process.program_name)}",'
+        f'process="{escape(process.name)}"'
+    )
+    lines = [
+        f"taskmaster_process_state{{{labels},"
+        f'state="{process.status.value}"}} 1\n',
+        f"taskmaster_process_retries{{{labels}}} {process.retries}\n",
+        f"taskmaster_process_exit_code{{{labels}}} {process.returncode}\n"
+        if process.returncode is not None
+        else "",
+        f"taskmaster_process_start_time_seconds{{{labels}}} "
+        f"{process.started_at.timestamp():.3f}\n"
+        if process.started_at
+        else "",
+    ]
+    resources = process.get_resources()
+    if resources:
+        lines.extend(
+            [
+                f"taskmaster_process_cpu_percent{{{labels}}} "
+                f"{resources['cpu']}\n",
+                f"taskmaster_process_resident_memory_bytes{{{labels}}} "
+                f"{resources['rss']}\n",
+                f"taskmaster_process_open_fds{{{labels}}} "
+                f"{resources['fds']}\n",
+            ]
+        )
+    else:
+        lines.extend(["", "", ""])
+    return tuple(lines)
+
+
+class MetricsRenderer:
+    # Lines of a process are only formatted again when it changed state
+    # or was sampled again, and the whole process section is reused as
+    # long as nothing changed at all since the previous scrape
+
+    def __init__(self):
+        self.lines: Dict[str, Tuple[tuple, Tuple[str, ...]]] = {}
+        self.section_key: tuple = None
+        self.section = ""
+
+    def render_processes(self, processes: List) -> str:
+        key = (event_bus.version, sampler.sweeps, len(processes))
+        if key == self.section_key:
+            return self.section
+        cached = {}
+        for process in processes:
+            process_key = (id(process), process.version, sampler.sweeps)
+            entry = self.lines.get(process.name)
+            if entry is None or entry[0] != process_key:
+                entry = (process_key, process_lines(process))
+            cached[process.name] = entry
+        self.lines = cached
+        parts = []
+        for index, (name, kind, help_text) in enumerate(PROCESS_FAMILIES):
+            parts.append(f"# TYPE {name} {kind}\n# HELP {name} {help_text}\n")
+            parts.extend(lines[index] for _, lines in cached.values())
+        self.section_key = key
+        self.section = "".join(parts)
+        return self.section
+
+    def render(self, processes: List) -> str:
+        spawns = spawner.get_stats()
+        parts = [
+            self.render_processes(processes),
+            "# TYPE taskmaster_spawns counter\n"
+            f"taskmaster_spawns_total {spawns['spawned']}\n",
+            "# TYPE taskmaster_spawn_queue gauge\n"
+            f"taskmaster_spawn_queue {spawns['queued']}\n",
+            "# TYPE taskmaster_spawn_latency_seconds summary\n"
+            "taskmaster_spawn_latency_seconds_count "
+            f"{spawns['latency_count']}\n"
+            "taskmaster_spawn_latency_seconds_sum "
+            f"{spawns['latency_total']}\n",
+            "# TYPE taskmaster_state_changes counter\n"
+            f"taskmaster_state_changes_total {event_bus.version}\n",
+            "# TYPE taskmaster_event_loop_lag_seconds gauge\n"
+            f"taskmaster_event_loop_lag_seconds {monitor.lag}\n",
+            "# TYPE taskmaster_event_loop_lag_probe_seconds histogram\n",
+            histogram_lines(
+                "taskmaster_event_loop_lag_probe_seconds",
+                "",
+                monitor.lag_histogram,
+            ),
+            "# TYPE taskmaster_event_loop_blocked counter\n"
+            f"taskmaster_event_loop_blocked_total {monitor.slow_callbacks}\n",
+            "# TYPE taskmaster_command_latency_seconds histogram\n",
+        ]
+        for command, histogram in monitor.commands.items():
+            parts.append(
+                histogram_lines(
+                    "taskmaster_command_latency_seconds",
+                    f'command="{escape(command)}",',
+                    histogram,
+                )
+            )
+        parts.append("# EOF\n")
+        return "".join(parts)
+
+
+def histogram_lines(name: str, labels: str, histogram: Histogram) -> str:
+    lines = [
+        f'{name}_bucket{{{labels}le="{bound}"}} {count}\n'
+        for bound, count in zip(
+            [*histogram.bounds, "+Inf"], histogram.cumulative()
+        )
+    ]
+    labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+    lines.append(f"{name}_count{labels} {histogram.count}\n")
+    lines.append(f"{name}_sum{labels} {histogram.total}\n")
+    return "".join(lines)
+
+
+class MetricsExporter:
+    # Minimal HTTP listener serving `GET /metrics`
+
+    def __init__(self):
+        self.host = DEFAULT_METRICS_HOST
+        self.port = DEFAULT_METRICS_PORT
+        self.server: asyncio.Server = None
+        self.renderer = MetricsRenderer()
+        self.get_processes: Callable[[], Iterable] = None
+        self.scrapes = 0
+
+    def configure(
+        self, host: str, port: int, get_processes: Callable[[], Iterable]
+    ):
+        self.get_processes = get_processes
+        if (host, port) == (self.host, self.port):
+            return
+        self.host = host
+        self.port = port
+        asyncio.create_task(self.restart())
+
+    async def restart(self):
+        await self.stop()
+        if not self.port:
+            return
+        try:
+            self.server = await asyncio.start_server(
+                self.handle, self.host, self.port, limit=MAX_REQUEST_SIZE
+            )
+            logger.info(f"Metrics served on http://{self.host}:{self.port}")
+        except OSError as e:
+            logger.error(f"Cannot serve metrics on port {self.port}: {e}")
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            method, path, *_ = request.split(b" ", 2)
+            if method != b"GET":
+                status, body = "405 Method Not Allowed", ""
+            elif path.split(b"?")[0] != b"/metrics":
+                status, body = "404 Not Found", ""
+            else:
+                self.scrapes += 1
+                status = "200 OK"
+                body = self.renderer.render(list(self.get_processes()))
+            payload = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n".encode()
+                + payload
+            )
+            await writer.drain()
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ValueError,
+            ConnectionError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+
+exporter = MetricsExporter()
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+LAG_PROBE_INTERVAL = 0.1  # seconds between two event loop lag probes
+DEFAULT_SLOW_THRESHOLD = 0.5  # seconds, 0 disables the slow callback logs
+# upper bounds (seconds) of the histogram buckets, the last one is +Inf
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0]
+
+
+class Histogram:
+    def __init__(self, bounds: List[float] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def cumulative(self) -> List[int]:
+        # counts of the values below each bound, as exported
+        counts = []
+        running = 0
+        for count in self.counts:
+            running += count
+            counts.append(running)
+        return counts
+
+    def quantile(self, quantile: float) -> float:
+        # upper bound of the bucket holding the quantile, never above the
+        # largest value observed
+        if not self.count:
+            return 0.0
+        rank = quantile * self.count
+        for bound, count in zip(self.bounds, self.cumulative()):
+            if count >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def get_stats(self) -> dict:
+        return {
+            "count": self.count,
+            "total": round(self.total, 6),
+            "max": round(self.max, 6),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": dict(
+                zip(
+                    [str(bound) for bound in self.bounds] + ["+Inf"],
+                    self.cumulative(),
+                )
+            ),
+        }
+
+
+class LoopMonitor:
+    # Measures how late the event loop wakes a sleeping task up, and how
+    # long every control command takes to be handled. A watchdog thread
+    # dumps the stack of the loop thread when the loop stops answering for
+    # longer than `threshold`, showing which callback blocks it.
+
+    def __init__(self):
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.lag_histogram = Histogram()
+        self.commands: Dict[str, Histogram] = {}
+        self.threshold = DEFAULT_SLOW_THRESHOLD
+        self.task: asyncio.Task = None
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id: int = None
+        self.watchdog: threading.Thread = None
+        self.stopped = threading.Event()
+        self.slow_callbacks = 0
+        self.slow_commands = 0
+
+    def configure(self, threshold: float):
+        self.threshold = threshold
+
+    def start(self):
+        if self.task is None:
+            self.loop_thread_id = threading.get_ident()
+            self.heartbeat = time.monotonic()
+            self.task = asyncio.create_task(self.probe())
+        if self.watchdog is None:
+            self.stopped.clear()
+            self.watchdog = threading.Thread(
+                target=self.watch, name="loop-watchdog", daemon=True
+            )
+            self.watchdog.start()
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.watchdog:
+            self.stopped.set()
+            self.watchdog = None
+
+    async def probe(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + LAG_PROBE_INTERVAL
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            self.heartbeat = time.monotonic()
+            self.lag = max(loop.time() - expected, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+            self.lag_histogram.observe(self.lag)
+
+    def watch(self):
+        # runs in its own thread, the loop thread cannot report itself
+        reported = None
+        while not self.stopped.wait(LAG_PROBE_INTERVAL):
+            if not self.threshold:
+                continue
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat - LAG_PROBE_INTERVAL
+            if blocked < self.threshold or reported == heartbeat:
+                continue
+            # one snapshot per stall, taken while the callback still runs
+            reported = heartbeat
+            self.slow_callbacks += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            logger.warning(
+                f"Event loop blocked for more than {blocked:.3f}s, "
+                f"loop thread stack:\n{stack}"
+            )
+
+    def record_command(self, command: str, seconds: float):
+        histogram = self.commands.get(command)
+        if histogram is None:
+            histogram = self.commands[command] = Histogram()
+        histogram.observe(seconds)
+        if self.threshold and seconds > self.threshold:
+            self.slow_commands += 1
+            logger.warning(f"Command {command} took {seconds:.3f}s")
+
+    def get_stats(self) -> dict:
+        return {
+            "loop_lag": round(self.lag, 6),
+            "max_loop_lag": round(self.max_lag, 6),
+            "lag_histogram": self.lag_histogram.get_stats(),
+            "slow_threshold": self.threshold,
+            "slow_callbacks": self.slow_callbacks,
+            "slow_commands": self.slow_commands,
+            "commands": {
+                command: histogram.get_stats()
+                for command, histogram in self.commands.items()
+            },
+        }
+
+
+monitor = LoopMonitor()
@@ -1,110 +1,305 @@
 import asyncio
 import logging
+import random
+import time
+from collections import deque
 from dataclasses import dataclass
-from typing import List
-from enums import AutoRestart, Status, Signal
+from enums import AutoRestart, Status
 from datetime import datetime
 from definitions import ProgramDefinition
-from mail import email_alert
+from alerts import Alert, alert_dispatcher
+from events import Event, event_bus
+from spawner import spawner
+from reaper import reaper
+from timers import Timer, timers
+from sampler import sampler
+from capture import (
+    DISCARD_OUTPUT,
+    BatchWriter,
+    OutputLog,
+    capture_path,
+    writer_pool,
+)
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class Process:
+    # Runtime state of one process. Its configuration (cmd, env, exitcodes,
+    # ...) is read from the definition of its program, shared by all the
+    # processes of the program and replaced as a whole on reload.
     name: str
-    cmd: str
-    cwd: str
-    env: dict
-    umask: int
-    stdout: str
-    stderr: str
-    autorestart: AutoRestart
-    exitcodes: List[int]
-    startretries: int
-    starttime: int
-    stoptime: int
+    definition: ProgramDefinition
     status: Status = Status.STOPPED
     process: asyncio.subprocess.Process = (
         None  # Adjusted to asyncio subprocess
     )
-    stopsignal: Signal = Signal("TERM")
     returncode: int = None
     retries: int = 0
     started_at: int = 0
     stopped_at: int = 0
-    mail_alerting: bool = False
+    killed: bool = False
     stdout_reader_task: asyncio.Task = None
     stderr_reader_task: asyncio.Task = None
-    watch_successfull_start_task: asyncio.Task = None
+    start_timer: Timer = None
+    stop_timer: Timer = None
+    version: int = 0
+    spawn_slot: bool = False
+    start_pending: bool = False  # scheduled, no child spawned yet
+    retired: bool = False  # replaced or removed from its program
+    stdout_log: OutputLog = None
+    stderr_log: OutputLog = None
+    backoff_delay: float = 0
+    crash_times: deque = None  # created on the first crash
+    retry_timer: Timer = None
+
+    def __getattr__(self, name: str):
+        # only called for names which are not runtime state
+        if name == "definition":
+            raise AttributeError(name)
+        return getattr(self.definition, name)
+
+    @property
+    def program_name(self) -> str:
+        return self.definition.name
+
+    @property
+    def autorestart(self) -> AutoRestart:
+        # a killed process is never restarted, whatever its program says
+        if self.killed:
+            return AutoRestart.never
+        return self.definition.autorestart
+
+    def set_status(self, status: Status):
+        old_status = self.status
+        self.status = status
+        if old_status == status:
+            return
+        if self.retired:
+            # a late exit of a replaced process must not overwrite the
+            # current process of the same name in the change log
+            return
+        event_bus.record_change(self)
+        event_bus.publish(
+            Event(
+                program=self.program_name,
+                process=self.name,
+                old_state=old_status.value,
+                state=status.value,
+                pid=self.process.pid if self.process else None,
+                returncode=self.returncode,
+                retries=self.retries,
+                version=self.version,
+            )
+        )
+
+    def alert(self, event: str, message: str):
+        if not self.alerts:
+            return
+        alert_dispatcher.notify(
+            self.alerts,
+            Alert(
+                event=event,
+                program=self.program_name,
+                process=self.name,
+                message=message,
+                pid=self.process.pid if self.process else None,
+                returncode=self.returncode,
+                retries=self.retries,
+                time=time.time(),
+            ),
+        )
+
+    def release_spawn_slot(self):
+        if self.spawn_slot:
+            self.spawn_slot = False
+            spawner.release()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    def schedule_start(self):
+        # STARTING right away, so a stop or kill arriving before the child
+        # is spawned cancels the start instead of finding nothing to stop
+        self.start_pending = True
+        self.set_status(Status.STARTING)
+        asyncio.create_task(self.start())
+
+    def cancel_start(self) -> bool:
+        if not self.start_pending:
+            return False
+        self.start_pending = False
+        self.set_status(Status.STOPPED)
+        return True
+
+    @staticmethod
+    def output_pipe(target: str) -> int:
+        if target == DISCARD_OUTPUT:
+            return asyncio.subprocess.DEVNULL
+        return asyncio.subprocess.PIPE
+
+    def acquire_output_writer(self, stream_name: str) -> BatchWriter:
+        target = getattr(self, stream_name)
+        return writer_pool.acquire(
+            capture_path(self.name, stream_name)
+            if target == "PIPE"
+            else target,
+            max_bytes=getattr(self, f"{stream_name}_logfile_maxbytes"),
+            backups=getattr(self, f"{stream_name}_logfile_backups"),
+        )
+
+    def refresh_output_logs(self):
+        # following writes of a running process go to the new path and
+        # rotation settings
+        for stream_name in ["stdout", "stderr"]:
+            output_log = self.get_output_log(stream_name)
+            if output_log is None or output_log.writer is None:
+                continue
+            if getattr(self, stream_name) == DISCARD_OUTPUT:
+                output_log.detach()
+            else:
+                output_log.attach(self.acquire_output_writer(stream_name))
+
+    def get_output_log(self, stream_name: str) -> OutputLog:
+        if stream_name == "stderr":
+            return self.stderr_log
+        return self.stdout_log
 
     async def start(self):
+        # run by schedule_start, stop and kill cancel it until the child
+        # is spawned
+        if not self.start_pending:
+            logger.debug(f"Process {self.name} start cancelled")
+            return f"Process {self.name} start cancelled."
         try:
-            self.status = Status.STARTING
             self.returncode = None
             self.stopped_at = 0
-            # Adjusted to use asyncio's subprocess and properly handle stdout/stderr
-            self.process = await asyncio.create_subprocess_exec(
-                *self.cmd.split(),
-                cwd=self.cwd,
-                env=self.env,
-                umask=self.umask,
-                stdout=(
-                    asyncio.subprocess.PIPE
-                    if self.stdout == "PIPE"
-                    else open(self.stdout, "w")
-                ),
-                stderr=(
-                    asyncio.subprocess.PIPE
-                    if self.stderr == "PIPE"
-                    else open(self.stderr, "w")
-                ),
-            )
+            requested_at = time.monotonic()
+            await spawner.acquire(self.priority)
+            self.spawn_slot = True
+            if not self.start_pending:
+                # stopped or killed while waiting for a spawn slot
+                logger.debug(f"Process {self.name} start cancelled")
+                self.release_spawn_slot()
+                return f"Process {self.name} start cancelled."
+            try:
+                process = await self.spawn()
+            finally:
+                # the slot only covers the spawn, not the `starttime` wait
+                self.release_spawn_slot()
+            if not self.start_pending or self.killed:
+                # stopped or killed while being spawned: its exit is
+                # expected, not a crash
+                logger.debug(f"Process {self.name} start cancelled")
+                self.killed = True
+                process.kill()
+                return f"Process {self.name} start cancelled."
+            self.start_pending = False
+            self.process = process
             self.started_at = datetime.now()
+            spawner.record_latency(time.monotonic() - requested_at)
             logger.debug(
                 f"Process {self.name}, pid {self.process.pid}, STARTING"
             )
-            if self.stdout == "PIPE":
-                # Start reading stdout asynchronously
-                logger.debug(f"Reading stdout for process {self.name}")
-                self.stdout_reader_task = asyncio.create_task(
-                    self.read_stdout()
-                )
-            if self.stderr == "PIPE":
-                # Start reading stderr asynchronously
-                logger.debug(f"Reading stderr for process {self.name}")
-                self.stderr_reader_task = asyncio.create_task(
-                    self.read_stderr()
-                )
-            self.watch_successfull_start_task = asyncio.create_task(
-                self.watch_successfull_start()
+            if self.process.stdout:
+                # Start capturing stdout asynchronously
+                logger.debug(f"Capturing stdout for process {self.name}")
+                await self.capture_output("stdout", self.process.stdout)
+            if self.process.stderr:
+                # Start capturing stderr asynchronously
+                logger.debug(f"Capturing stderr for process {self.name}")
+                await self.capture_output("stderr", self.process.stderr)
+            self.start_timer = timers.schedule(
+                self.starttime, self.confirm_start, self.program_name
             )
-            await self.monitor_process()
+            if not reaper.enabled:
+                await self.monitor_process()
         except Exception as e:
+            self.start_pending = False
             self.stopped_at = datetime.now()
-            self.status = Status.FATAL
+            self.set_status(Status.FATAL)
             logger.debug(f"Error starting process {self.name}: {e}")
             self.retry()
             return f"Error starting process {self.name}: {e}"
         return f"Process {self.name} started successfully."
 
+    async def spawn(self):
+        # Outputs are piped to the server, which captures and writes
+        # them to their log files, unless they are discarded
+        args = self.cmd.split()
+        options = {
+            "cwd": self.cwd,
+            "env": self.env,
+            "umask": self.umask,
+            "stdout": self.output_pipe(self.stdout),
+            "stderr": self.output_pipe(self.stderr),
+        }
+        if reaper.enabled:
+            return await reaper.spawn(args, self.handle_exit, **options)
+        return await asyncio.create_subprocess_exec(*args, **options)
+
+    async def capture_output(self, stream_name: str, pipe):
+        output_log = self.get_output_log(stream_name) or OutputLog(
+            f"Process {self.name} {stream_name}"
+        )
+        setattr(self, f"{stream_name}_log", output_log)
+        run = output_log.start_run(self.acquire_output_writer(stream_name))
+        if reaper.enabled:
+            await reaper.capture(pipe, output_log, run)
+        else:
+            setattr(
+                self,
+                f"{stream_name}_reader_task",
+                asyncio.create_task(output_log.capture(pipe, run)),
+            )
+
     async def monitor_process(self):
         # Wait for the process to finish asynchronously
-        self.returncode = await self.process.wait()
+        self.handle_exit(await self.process.wait())
+
+    def handle_exit(self, returncode: int):
+        self.returncode = returncode
         self.stopped_at = datetime.now()
-        self.watch_successfull_start_task.cancel()
+        if self.start_timer:
+            self.start_timer.cancel()
+        if self.status == Status.STOPPING:
+            if self.stop_timer:
+                self.stop_timer.cancel()
+            logger.info(f"Process {self.name} stopped")
+            self.set_status(Status.STOPPED)
+            return
+        if self.killed:
+            # killed by the supervisor (restart, reload, removal): not a
+            # crash, so no crash history, alert nor retry
+            logger.info(f"Process {self.name} exited after being killed")
+            return
+        if (
+            self.stopped_at - self.started_at
+        ).total_seconds() >= self.backoff.healthy_time:
+            # a sustained healthy run starts a new retry cycle
+            logger.debug(f"Process {self.name} ran healthy, resetting retries")
+            self.reset()
         if self.returncode not in self.exitcodes:
             logger.info(
                 f"Process {self.name} exited with unexpected code {self.returncode}"
             )
-            self.status = Status.FATAL
-            if self.autorestart == AutoRestart.unexpected:
+            if self.crash_times is None:
+                self.crash_times = deque()
+            self.crash_times.append(time.monotonic())
+            self.set_status(Status.FATAL)
+            self.alert(
+                "FATAL",
+                f"Process {self.name} exited with unexpected code "
+                f"{self.returncode}",
+            )
+            if self.autorestart != AutoRestart.never:
                 self.retry()
         else:
             logger.info(
                 f"Process {self.name} exited with code {self.returncode}"
             )
-            self.status = Status.EXITED
+            self.set_status(Status.EXITED)
             if self.autorestart == AutoRestart.always:
                 self.retry()
 
@@ -112,15 +307,11 @@ class Process:
         if self.retries >= self.startretries:
             log_string = f"Max retries reached for process: {self.name}"
             if self.returncode not in self.exitcodes:
-                self.status = Status.ABORTED
-                if self.mail_alerting:
-                    try:
-                        email_alert(
-                            f"Process {self.name} ABORTED",
-                            f"Process: {self.name} aborted after max retries: {self.retries}",
-                        )
-                    except Exception as e:
-                        logger.debug(f"Error sending email alert: {e}")
+                self.set_status(Status.ABORTED)
+                self.alert(
+                    "ABORTED",
+                    f"Process: {self.name} aborted after max retries: {self.retries}",
+                )
                 log_string += f" after unexpected exit code ({self.returncode}): ABORTED."
             logger.info(log_string)
             return
@@ -128,22 +319,68 @@ class Process:
             logger.debug(f"AutoRestart set to 'never' for process {self.name}")
             return
         self.retries += 1
+        delay = self.next_backoff_delay()
         logger.info(
             f"Retrying process {self.name} ({self.retries}/{self.startretries})"
+            f" in {delay:.2f}s"
+        )
+        if delay <= 0:
+            self.schedule_start()
+            return
+        self.set_status(Status.BACKOFF)
+        self.alert(
+            "BACKOFF",
+            f"Process {self.name} retrying "
+            f"({self.retries}/{self.startretries}) in {delay:.2f}s",
+        )
+        self.retry_timer = timers.schedule(
+            delay, self.retry_now, self.program_name
         )
-        asyncio.create_task(self.start())
 
-    async def wait_for_process_to_stop(self):
-        try:
-            await asyncio.wait_for(self.process.wait(), timeout=self.stoptime)
-            logger.info(f"Process {self.name} stopped")
-            self.stopped_at = datetime.now()
-            self.status = Status.STOPPED
-            if self.stdout_reader_task:
-                self.stdout_reader_task.cancel()
-            if self.stderr_reader_task:
-                self.stderr_reader_task.cancel()
-        except asyncio.TimeoutError:
+    def is_crash_looping(self) -> bool:
+        now = time.monotonic()
+        while (
+            self.crash_times
+            and now - self.crash_times[0] > self.backoff.crashloop_window
+        ):
+            self.crash_times.popleft()
+        return len(self.crash_times or ()) >= self.backoff.crashloop_max
+
+    def next_backoff_delay(self) -> float:
+        if self.is_crash_looping():
+            message = (
+                f"Process {self.name} crashed {len(self.crash_times)} times"
+                f" in {self.backoff.crashloop_window}s, parked in BACKOFF"
+                f" for {self.backoff.max}s"
+            )
+            logger.warning(message)
+            self.alert("FLAPPING", message)
+            self.crash_times.clear()
+            self.backoff_delay = self.backoff.max
+        elif not self.backoff_delay:
+            self.backoff_delay = self.backoff.initial
+        else:
+            self.backoff_delay = min(
+                self.backoff_delay * self.backoff.multiplier, self.backoff.max
+            )
+        jitter = random.uniform(-self.backoff.jitter, self.backoff.jitter)
+        return self.backoff_delay * (1 + jitter)
+
+    def retry_now(self):
+        self.retry_timer = None
+        if self.status == Status.BACKOFF:
+            self.schedule_start()
+
+    def cancel_retry(self) -> bool:
+        if self.retry_timer is None:
+            return False
+        self.retry_timer.cancel()
+        self.retry_timer = None
+        return True
+
+    def stop_timed_out(self):
+        self.stop_timer = None
+        if self.status == Status.STOPPING:
             logger.warning(
                 f"Process {self.name} did not stop in time, killing it"
             )
@@ -153,31 +390,84 @@ class Process:
         logger.debug(
             f"Stopping process {self.name} with signal {self.stopsignal}"
         )
-        if self.process:
-            self.watch_successfull_start_task.cancel()
+        if self.cancel_start():
+            logger.info(f"Process {self.name} start cancelled")
+        elif self.cancel_retry():
+            self.set_status(Status.STOPPED)
+            logger.info(f"Process {self.name} retry cancelled")
+        elif self.status == Status.STOPPING:
+            logger.info(f"Process {self.name} is already stopping")
+        elif self.process and self.process.returncode is None:
+            if self.start_timer:
+                self.start_timer.cancel()
             self.process.send_signal(self.stopsignal)
-            self.status = Status.STOPPING
-            asyncio.create_task(self.wait_for_process_to_stop())
+            self.set_status(Status.STOPPING)
+            self.stop_timer = timers.schedule(
+                self.stoptime, self.stop_timed_out, self.program_name
+            )
             logger.info(f"Shutdown initiated for process {self.name}")
         else:
             logger.info(f"Process {self.name} is already stopped")
 
     def kill(self):
-        self.autorestart = AutoRestart.never
+        self.killed = True
         logger.debug(f"Killing process {self.name}: {self.process}")
-        if self.process:
+        if self.cancel_start():
+            logger.info(f"Process {self.name} start cancelled")
+        elif self.cancel_retry():
+            self.set_status(Status.STOPPED)
+            logger.info(f"Process {self.name} retry cancelled")
+        elif self.process:
+            for timer in [self.start_timer, self.stop_timer]:
+                if timer:
+                    timer.cancel()
             try:
                 self.process.kill()
                 self.stopped_at = datetime.now()
-                self.status = Status.FATAL
+                self.set_status(Status.FATAL)
                 logger.info(f"Process {self.name} killed")
             except ProcessLookupError:
                 logger.info(f"Process {self.name} is already exited")
         else:
             logger.info(f"Process {self.name} is already stopped")
 
+    async def wait_until_exited(self):
+        if self.process and self.process.returncode is None:
+            await self.process.wait()
+
     def reset(self):
         self.retries = 0
+        self.backoff_delay = 0
+        self.crash_times = None
+
+    def get_uptime_seconds(self) -> float:
+        if not self.started_at:
+            return 0
+        difference = (
+            self.stopped_at - self.started_at
+            if self.stopped_at
+            else datetime.now() - self.started_at
+        )
+        return round(difference.total_seconds(), 3)
+
+    def get_snapshot(self) -> dict:
+        return {
+            "program": self.program_name,
+            "name": self.name,
+            "state": self.status.value,
+            "pid": self.process.pid if self.process else None,
+            "returncode": self.returncode,
+            "uptime": self.get_uptime_seconds(),
+            "retries": self.retries,
+            "version": self.version,
+            "resources": self.get_resources(),
+        }
+
+    def get_resources(self) -> dict:
+        # last sample of the resource sampler, while the process is alive
+        if not self.is_alive():
+            return None
+        return sampler.get(self.name)
 
     def get_uptime(self) -> int:
         if not self.started_at:
@@ -189,48 +479,17 @@ class Process:
         )
         return str(difference)
 
-    async def watch_successfull_start(self):
-        await asyncio.sleep(self.starttime)
+    def confirm_start(self):
+        self.start_timer = None
         if self.returncode is None and self.status == Status.STARTING:
-            self.status = Status.RUNNING
+            self.set_status(Status.RUNNING)
             logger.info(
                 f"Process {self.name}, pid {self.process.pid}, RUNNING"
             )
 
     def update(self, program_definition: ProgramDefinition):
-        keys = [
-            "cmd",
-            "cwd",
-            "env",
-            "umask",
-            "stdout",
-            "stderr",
-            "autorestart",
-            "exitcodes",
-            "startretries",
-            "starttime",
-            "stoptime",
-            "stopsignal",
-        ]
-        attributes = {
-            key: program_definition.__dict__[key] for key in set(keys)
-        }
-        self.__dict__.update(attributes)
+        # a single reference swap, the process never sees half a definition
+        self.definition = program_definition
+        self.refresh_output_logs()
         logger.info(f"Process {self.name} updated")
         return f"Process {self.name} updated successfully"
-
-    async def read_stdout(self):
-        while True:
-            line = await self.process.stdout.readline()
-            if not line:
-                break
-            logger.info(f"[stdout] {self.name}: {line.decode().strip()}")
-        logger.debug(f"Process {self.name} stdout reader stopped")
-
-    async def read_stderr(self):
-        while True:
-            line = await self.process.stderr.readline()
-            if not line:
-                break
-            logger.info(f"[stderr] {self.name}: {line.decode().strip()}")
-        logger.debug(f"Process {self.name} stderr reader stopped")
@@ -1,10 +1,14 @@
 import asyncio
 import logging
-from dataclasses import dataclass, field
-from typing import Dict, List
+import time
+from dataclasses import dataclass, field, fields
+from typing import Dict, List, Set
 from process import Process
-from definitions import ProgramDefinition
-from enums import Status
+from capture import DISCARD_OUTPUT
+from definitions import ProgramDefinition, rolling_batch_size
+from enums import AutoRestart, Status
+from events import event_bus
+from timers import timers
 
 logger = logging.getLogger(__name__)
 
@@ -13,38 +17,46 @@ def compare_programs(
     old_program: ProgramDefinition, new_program: ProgramDefinition
 ) -> List[str]:
 
+    if old_program is new_program:
+        # unchanged blocks are reused by the config cache
+        return []
     differences = []
 
-    for attr in new_program.__dict__.keys():
-        if getattr(old_program, attr) != getattr(new_program, attr):
-            differences.append(attr)
+    for attribute in fields(new_program):
+        if getattr(old_program, attribute.name) != getattr(
+            new_program, attribute.name
+        ):
+            differences.append(attribute.name)
     return differences
 
 
-def critical_attribute(attributes: List[str]) -> bool:
-    critical = [
-        "name",
-        "cmd",
-        "workingdir",
-        "umask",
-        "stdout",
-        "stderr",
-    ]
-    intersection = list(set(attributes) & set(critical))
-    if intersection:
-        return True
-    return False
+# running processes must be respawned for these to take effect, the
+# other attributes are applied in place or on the next start
+RESPAWN_ATTRIBUTES = ["cmd", "cwd", "umask"]
 
 
 @dataclass
-class Program(ProgramDefinition):
-    processes: Dict[int, Process] = field(default_factory=dict)
+class ProgramUpdate:
+    differences: List[str]
+    respawn: List[int] = field(default_factory=list)
+    added: List[int] = field(default_factory=list)
+    removed: List[int] = field(default_factory=list)
+
 
+class Program:
     def __init__(self, program_definition: ProgramDefinition):
-        # Init the ProgramDefinition attributes coming from herited class
-        super().__init__(**program_definition.__dict__)
-        # Init the Program attributes
-        self.processes = {}
+        # the definition is shared with the processes of the program
+        self.definition = program_definition
+        self.processes: Dict[int, Process] = {}
+        self.state = Status.STOPPED
+        self.dependency_task: asyncio.Task = None
+        self.rolling_task: asyncio.Task = None
+
+    def __getattr__(self, name: str):
+        # name, cmd, numprocs, ... come from the definition
+        if name == "definition":
+            raise AttributeError(name)
+        return getattr(self.definition, name)
 
     def start(self):
         logger.info(f"Starting task {self.name}")
@@ -62,24 +74,8 @@ class Program(ProgramDefinition):
                     )
                     processes_already_started += 1
                     continue
-                self.processes[process_id] = Process(
-                    name=f"{self.name}-{process_id}",
-                    cmd=self.cmd,
-                    cwd=self.cwd,
-                    env=self.env,
-                    umask=self.umask,
-                    stdout=self.stdout,
-                    stderr=self.stderr,
-                    exitcodes=self.exitcodes,
-                    stopsignal=self.stopsignal,
-                    starttime=self.starttime,
-                    stoptime=self.stoptime,
-                    autorestart=self.autorestart,
-                    startretries=self.startretries,
-                    mail_alerting=self.mail_alerting,
-                )
                 logger.debug(f"Starting process {self.name}-{process_id}")
-                asyncio.create_task(self.processes[process_id].start())
+                self.start_process(process_id)
                 logger.debug(f"Process {self.name}-{process_id} started")
             except Exception as e:
                 logger.debug(
@@ -96,8 +92,24 @@ class Program(ProgramDefinition):
         logger.info(log_string)
         return log_string
 
+    def new_process(self, process_id: int) -> Process:
+        return Process(
+            name=f"{self.name}-{process_id}", definition=self.definition
+        )
+
+    def start_process(self, process_id: int):
+        if self.processes.get(process_id) is not None:
+            # the new process replaces any pending retry
+            self.processes[process_id].cancel_retry()
+            self.processes[process_id].retired = True
+        process = self.new_process(process_id)
+        self.processes[process_id] = process
+        process.schedule_start()
+
     def stop(self):
         self.state = Status.STOPPED
+        self.cancel_dependency_task()
+        self.cancel_rolling_task()
         logger.info(f"Stopping task {self.name}")
         try:
             # Wait for process to stop
@@ -116,6 +128,161 @@ class Program(ProgramDefinition):
         logger.info(f"Program {self.name} stop initiated successfully")
         return f"Program {self.name} stop initiated successfully"
 
+    def start_after(self, dependencies: List["Program"]):
+        self.cancel_dependency_task()
+        self.dependency_task = asyncio.create_task(
+            self.start_when_ready(dependencies)
+        )
+        return f"Task {self.name} waiting for its dependencies"
+
+    async def start_when_ready(self, dependencies: List["Program"]):
+        names = ", ".join(dependency.name for dependency in dependencies)
+        logger.info(f"Task {self.name} waiting for {names} to be RUNNING")
+        ready = await asyncio.gather(
+            *[dependency.wait_until_running() for dependency in dependencies]
+        )
+        if not all(ready):
+            logger.error(
+                f"Task {self.name} not started: a dependency failed ({names})"
+            )
+            return
+        logger.debug(f"Task {self.name}: dependencies are RUNNING")
+        self.start()
+
+    def cancel_dependency_task(self):
+        if self.dependency_task and not self.dependency_task.done():
+            logger.debug(f"Task {self.name}: no longer waiting for dependencies")
+            self.dependency_task.cancel()
+        self.dependency_task = None
+
+    def is_running(self) -> bool:
+        # processes which exited with an expected code count as ready
+        for process_id in range(self.numprocs):
+            process = self.processes.get(process_id)
+            if process is None:
+                return False
+            if process.status == Status.RUNNING:
+                continue
+            if (
+                process.status == Status.EXITED
+                and process.returncode in self.exitcodes
+            ):
+                continue
+            return False
+        return True
+
+    def has_failed(self) -> bool:
+        for process in self.processes.values():
+            if process.status == Status.ABORTED:
+                return True
+            if (
+                process.status == Status.FATAL
+                and process.autorestart == AutoRestart.never
+            ):
+                return True
+        return False
+
+    async def wait_until_running(self) -> bool:
+        subscriber = event_bus.subscribe(programs={self.name})
+        try:
+            while not self.is_running():
+                if self.has_failed():
+                    return False
+                # re-check on every state change of this program
+                await subscriber.queue.get()
+            return True
+        finally:
+            event_bus.unsubscribe(subscriber)
+
+    async def wait_until_exited(self):
+        await asyncio.gather(
+            *[process.wait_until_exited() for process in self.processes.values()]
+        )
+
+    def restart_rolling(
+        self, batch, process_ids: List[int] = None
+    ) -> asyncio.Task:
+        batch_size = rolling_batch_size(batch, self.numprocs)
+        self.cancel_rolling_task()
+        self.rolling_task = asyncio.create_task(
+            self.rolling_restart(
+                batch_size,
+                list(range(self.numprocs))
+                if process_ids is None
+                else process_ids,
+            )
+        )
+        return self.rolling_task
+
+    async def rolling_restart(
+        self, batch_size: int, process_ids: List[int]
+    ) -> str:
+        # a batch is replaced once the previous one is RUNNING (after its
+        # starttime), the others keep serving meanwhile
+        started_at = time.monotonic()
+        self.state = Status.RUNNING
+        batches = 0
+        for index in range(0, len(process_ids), batch_size):
+            batch = process_ids[index : index + batch_size]
+            batches += 1
+            logger.info(f"Task {self.name}: restarting processes {batch}")
+            await self.stop_processes(batch)
+            for process_id in batch:
+                self.start_process(process_id)
+            if not await self.wait_until_processes_running(batch):
+                message = (
+                    f"Rolling restart of task {self.name} aborted: "
+                    f"processes {batch} did not reach RUNNING"
+                )
+                logger.error(message)
+                return message
+        elapsed = time.monotonic() - started_at
+        message = (
+            f"Task {self.name}: {len(process_ids)} processes restarted "
+            f"in {batches} batches in {elapsed:.2f}s"
+        )
+        logger.info(message)
+        return message
+
+    async def stop_processes(self, process_ids: List[int]):
+        processes = [
+            self.processes[process_id]
+            for process_id in process_ids
+            if process_id in self.processes
+        ]
+        for process in processes:
+            process.stop()
+        await asyncio.gather(
+            *[process.wait_until_exited() for process in processes]
+        )
+
+    async def wait_until_processes_running(
+        self, process_ids: List[int]
+    ) -> bool:
+        subscriber = event_bus.subscribe(programs={self.name})
+        try:
+            while True:
+                states = [
+                    self.processes[process_id].status
+                    for process_id in process_ids
+                ]
+                if all(state == Status.RUNNING for state in states):
+                    return True
+                if any(
+                    state not in [Status.STARTING, Status.RUNNING]
+                    for state in states
+                ):
+                    return False
+                await subscriber.queue.get()
+        finally:
+            event_bus.unsubscribe(subscriber)
+
+    def cancel_rolling_task(self):
+        if self.rolling_task and not self.rolling_task.done():
+            logger.info(f"Task {self.name}: rolling restart cancelled")
+            self.rolling_task.cancel()
+        self.rolling_task = None
+
     def restart(self):
 
         self.kill()
@@ -126,90 +293,152 @@ class Program(ProgramDefinition):
 
     def kill(self):
         self.state = Status.STOPPED
+        self.cancel_dependency_task()
+        self.cancel_rolling_task()
+        # pending starttime, stoptime and retry deadlines of every process
+        timers.cancel_group(self.name)
         for process in self.processes.values():
             process.kill()
         return "Program killed"
 
-    def update(self, new_program: ProgramDefinition):
-        # check if critical attributes have changed
-        # kill -> all except :
-        # numprocs
-        # autostart
-        # autorestart
-        # exitcodes
-        # startretries
-        # starttime
-        # stopsignal
-        # stoptime
-        # if yes, kill all processes and relaunch them
-        # if no, update the program attributes
-        # finally remove extra processes if numprocs has decreased or add new processes if numprocs has increased
-        differences = compare_programs(self, new_program)
-        if not differences:
-            logger.debug(f"No changes for process group {self.name}")
-            return "Program unchanged"
+    def remove(self):
+        self.kill()
+        for process in self.processes.values():
+            process.retired = True
+        for process_id in range(self.numprocs):
+            event_bus.record_removal(f"{self.name}-{process_id}")
+        return "Program removed"
 
-        old_numprocs = self.numprocs
-        old_state = self.state
+    def needs_respawn(
+        self,
+        process: Process,
+        new_program: ProgramDefinition,
+        differences: List[str],
+    ) -> bool:
+        if not process.is_alive():
+            return False
+        if set(differences) & set(RESPAWN_ATTRIBUTES):
+            return True
+        # an output can be reopened in place, but not piped or unpiped
+        for stream_name in ["stdout", "stderr"]:
+            if stream_name in differences and (
+                getattr(process, stream_name) == DISCARD_OUTPUT
+            ) != (getattr(new_program, stream_name) == DISCARD_OUTPUT):
+                return True
+        return False
 
-        if critical_attribute(differences):
-            logger.info(
-                f"Critical attributes have changed for process group {self.name}. Reloading process group..."
+    def plan_update(self, new_program: ProgramDefinition) -> ProgramUpdate:
+        plan = ProgramUpdate(compare_programs(self.definition, new_program))
+        if not plan.differences:
+            return plan
+        kept = min(self.numprocs, new_program.numprocs)
+        plan.respawn = [
+            process_id
+            for process_id in range(kept)
+            if process_id in self.processes
+            and self.needs_respawn(
+                self.processes[process_id], new_program, plan.differences
             )
-            self.kill()
+        ]
+        plan.added = list(range(self.numprocs, new_program.numprocs))
+        plan.removed = list(range(new_program.numprocs, self.numprocs))
+        return plan
 
-        logger.debug(f"Updating process group {self.name}...")
-        self.__dict__.update(new_program.__dict__)
+    def apply_update(
+        self, new_program: ProgramDefinition, plan: ProgramUpdate
+    ) -> str:
+        if not plan.differences:
+            logger.debug(f"No changes for process group {self.name}")
+            return "Program unchanged"
+        old_state = self.state
+        logger.debug(
+            f"Updating process group {self.name}: "
+            f"{', '.join(plan.differences)} changed"
+        )
+        self.definition = new_program
 
-        # Add new processes
-        if self.numprocs > old_numprocs:
-            logger.debug(
-                f"Adding {self.numprocs - old_numprocs} new processes to process group {self.name}"
-            )
-            for process_id in range(old_numprocs, self.numprocs):
-                self.processes[process_id] = Process(
-                    name=f"{self.name}-{process_id}",
-                    cmd=self.cmd,
-                    cwd=self.cwd,
-                    env=self.env,
-                    umask=self.umask,
-                    stdout=self.stdout,
-                    stderr=self.stderr,
-                    exitcodes=self.exitcodes,
-                    stopsignal=self.stopsignal,
-                    starttime=self.starttime,
-                    stoptime=self.stoptime,
-                    autorestart=self.autorestart,
-                    startretries=self.startretries,
-                )
-        # Remove extra processes
-        elif self.numprocs < old_numprocs:
-            logger.debug(
-                f"Removing {old_numprocs - self.numprocs} processes from process group {self.name}"
-            )
-            for process_id in range(self.numprocs, old_numprocs):
+        for process_id in plan.removed:
+            if process_id in self.processes:
                 self.processes[process_id].kill()
+                self.processes[process_id].retired = True
                 del self.processes[process_id]
-        logger.debug(f"Process group {self.name}: updating processes...")
+            event_bus.record_removal(f"{self.name}-{process_id}")
+        for process_id in plan.added:
+            self.processes[process_id] = self.new_process(process_id)
+        # outputs are reopened now, the environment is used on next start
         for process in self.processes.values():
             process.update(new_program)
 
-        if self.autostart or old_state == Status.RUNNING:
+        if old_state == Status.RUNNING:
             self.start()
+        elif self.autostart and self.dependency_task is None:
+            # processes stopped by hand stay stopped, and a program still
+            # waiting for its dependencies starts them all once ready
+            for process_id in plan.added:
+                self.start_process(process_id)
+        if plan.respawn:
+            logger.info(
+                f"Task {self.name}: respawning processes {plan.respawn}"
+            )
+            # without rolling_batch, they are all replaced at once
+            self.restart_rolling(
+                self.rolling_batch or len(plan.respawn), plan.respawn
+            )
         return "Program updated"
 
-    def get_status(self) -> str:
-        return_string = ""
+    def update(self, new_program: ProgramDefinition) -> str:
+        return self.apply_update(new_program, self.plan_update(new_program))
+
+    def get_status(self, states: Set[str] = None) -> str:
+        lines = []
         for process_id in range(self.numprocs):
-            if self.processes.get(process_id):
-                status = self.processes[process_id].status
-                returncode = self.processes[process_id].returncode
-                uptime = self.processes[process_id].get_uptime()
-                if self.processes[process_id].process:
-                    pid = self.processes[process_id].process.pid
-                    return_string += f"{self.name}-{process_id}: {status} ({returncode}), pid {pid}, uptime {uptime}\n"
+            process = self.processes.get(process_id)
+            state = process.status if process else Status.STOPPED
+            if states and state.value not in states:
+                continue
+            if process:
+                status = process.status
+                returncode = process.returncode
+                uptime = process.get_uptime()
+                if process.process:
+                    pid = process.process.pid
+                    resources = process.get_resources()
+                    usage = (
+                        f", cpu {resources['cpu']}%, rss "
+                        f"{resources['rss'] // 1024}KB, fds {resources['fds']}"
+                        if resources
+                        else ""
+                    )
+                    lines.append(
+                        f"{self.name}-{process_id}: {status} ({returncode}), pid {pid}, uptime {uptime}{usage}\n"
+                    )
                 else:
-                    return_string += f"{self.name}-{process_id}: {status} ({returncode}), uptime {uptime}\n"
+                    lines.append(
+                        f"{self.name}-{process_id}: {status} ({returncode}), uptime {uptime}\n"
+                    )
+            else:
+                lines.append(f"{self.name}-{process_id}: STOPPED\n")
+        return "".join(lines)
+
+    def get_snapshot(self, states: Set[str] = None) -> List[dict]:
+        snapshot = []
+        for process_id in range(self.numprocs):
+            process = self.processes.get(process_id)
+            if process:
+                process_snapshot = process.get_snapshot()
             else:
-                return_string += f"{self.name}-{process_id}: STOPPED\n"
-        return return_string
+                process_snapshot = {
+                    "program": self.name,
+                    "name": f"{self.name}-{process_id}",
+                    "state": Status.STOPPED.value,
+                    "pid": None,
+                    "returncode": None,
+                    "uptime": 0,
+                    "retries": 0,
+                    "version": 0,
+                    "resources": None,
+                }
+            if states and process_snapshot["state"] not in states:
+                continue
+            snapshot.append(process_snapshot)
+        return snapshot
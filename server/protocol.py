@@ -0,0 +1,74 @@
+import json
+import logging
+from dataclasses import dataclass
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# Control socket protocol
+#
+# Frames are newline-delimited. A framed request is a JSON object:
+#   {"id": 42, "command": "status"}
+# and its response carries the same id so pipelined requests can be
+# matched even when they complete out of order:
+#   {"id": 42, "response": "..."}
+# Any line that is not a JSON object is handled as a plain text command
+# (e.g. from `nc`), and its response is written back as plain text.
+
+FRAME_SEPARATOR = b"\n"
+MAX_FRAME_SIZE = 64 * 1024
+MAX_INFLIGHT_REQUESTS = 256
+MAX_STREAMS = 1024  # subscribe and tail -f streams, all clients together
+SHUTDOWN_MESSAGE = "server_shutdown"
+
+
+@dataclass
+class Request:
+    command: str
+    id: Any = None
+    framed: bool = False
+
+
+def decode_frame(frame: bytes) -> Request:
+    # invalid UTF-8 must not drop the connection, it ends up as an
+    # unknown command
+    line = frame.decode(errors="replace").strip()
+    if line.startswith("{"):
+        try:
+            payload = json.loads(line)
+        except json.JSONDecodeError:
+            logger.debug(f"Frame is not valid JSON, handled as text: {line}")
+            return Request(command=line)
+        if isinstance(payload, dict):
+            return Request(
+                command=str(payload.get("command", "")),
+                id=payload.get("id"),
+                framed=True,
+            )
+    return Request(command=line)
+
+
+def encode_response(request: Request, response: Any) -> bytes:
+    if request.framed:
+        frame = json.dumps({"id": request.id, "response": response})
+        return frame.encode() + FRAME_SEPARATOR
+    if not isinstance(response, str):
+        response = json.dumps(response)
+    # if response does not end with \n, add it
+    if not response.endswith("\n"):
+        response = response + "\n"
+    return response.encode()
+
+
+def encode_event(request: Request, event: Any) -> bytes:
+    if request.framed:
+        frame = json.dumps({"id": request.id, "event": event.to_dict()})
+        return frame.encode() + FRAME_SEPARATOR
+    return str(event).encode() + FRAME_SEPARATOR
+
+
+def encode_error(request: Request, error: str) -> bytes:
+    if request.framed:
+        frame = json.dumps({"id": request.id, "error": error})
+        return frame.encode() + FRAME_SEPARATOR
+    return error.encode() + FRAME_SEPARATOR
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+from typing import Callable, Dict, List
+
+from capture import OutputLog
+
+logger = logging.getLogger(__name__)
+
+SUPERVISION_ENGINES = ["asyncio", "reaper"]
+DEFAULT_SUPERVISION_ENGINE = "asyncio"
+
+
+class ReapedProcess:
+    # Child spawned without asyncio's child watcher: its exit is collected
+    # by the Reaper, which calls `on_exit` then resolves `wait()`
+
+    def __init__(self, popen: subprocess.Popen):
+        self.popen = popen
+        self.pid = popen.pid
+        self.returncode: int = None
+        self.stdout = popen.stdout
+        self.stderr = popen.stderr
+        self.exited = asyncio.get_running_loop().create_future()
+
+    def exit(self, returncode: int):
+        self.returncode = returncode
+        # Popen must not try to wait for a pid which was already reaped
+        self.popen.returncode = returncode
+        if not self.exited.done():
+            self.exited.set_result(returncode)
+
+    def send_signal(self, sig: int):
+        if self.returncode is not None:
+            raise ProcessLookupError()
+        os.kill(self.pid, sig)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    async def wait(self) -> int:
+        return await asyncio.shield(self.exited)
+
+    def __repr__(self):
+        return f"<ReapedProcess {self.pid}>"
+
+
+class OutputProtocol(asyncio.Protocol):
+    # Feeds an OutputLog from the loop callbacks, without a reader task
+    def __init__(self, output_log: OutputLog, run: int):
+        self.output_log = output_log
+        self.run = run
+
+    def data_received(self, data: bytes):
+        self.output_log.append(data)
+
+    def connection_lost(self, exc: Exception):
+        self.output_log.end_run(self.run)
+        logger.debug(f"{self.output_log.name} reader stopped")
+
+
+class Reaper:
+    # One SIGCHLD handler reaps every exited child with waitpid(-1, WNOHANG)
+    # and dispatches the exit code to the callback registered for its pid.
+    # Every child of the server must then be spawned through the reaper.
+
+    def __init__(self):
+        self.enabled = False
+        self.callbacks: Dict[int, Callable[[int], None]] = {}
+        # children reaped before their callback was registered
+        self.unclaimed: Dict[int, int] = {}
+
+    def install(self):
+        if self.enabled:
+            return
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGCHLD, self.reap
+        )
+        self.enabled = True
+        logger.info("Supervising children with the SIGCHLD reaper")
+
+    def watch(self, pid: int, callback: Callable[[int], None]):
+        if pid in self.unclaimed:
+            callback(self.unclaimed.pop(pid))
+            return
+        self.callbacks[pid] = callback
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            returncode = os.waitstatus_to_exitcode(status)
+            callback = self.callbacks.pop(pid, None)
+            if callback is None:
+                self.unclaimed[pid] = returncode
+                continue
+            try:
+                callback(returncode)
+            except Exception as e:
+                logger.error(f"Error handling exit of pid {pid}: {e}")
+
+    async def spawn(
+        self,
+        args: List[str],
+        on_exit: Callable[[int], None],
+        **kwargs,
+    ) -> ReapedProcess:
+        process = ReapedProcess(subprocess.Popen(args, **kwargs))
+
+        def exited(returncode: int):
+            process.exit(returncode)
+            on_exit(returncode)
+
+        self.watch(process.pid, exited)
+        return process
+
+    async def capture(self, pipe, output_log: OutputLog, run: int):
+        await asyncio.get_running_loop().connect_read_pipe(
+            lambda: OutputProtocol(output_log, run), pipe
+        )
+
+    def get_stats(self) -> dict:
+        return {"enabled": self.enabled, "watched": len(self.callbacks)}
+
+
+reaper = Reaper()
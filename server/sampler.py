@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import os
+import time
+from array import array
+from typing import Callable, Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_INTERVAL = 5.0  # seconds, 0 disables the sampling
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def read_process(pid: int) -> Tuple[int, int, int]:
+    # cpu ticks (user + system), resident bytes and open fds of `pid`
+    with open(f"/proc/{pid}/stat", "rb") as file:
+        stat = file.read()
+    # the command name may contain spaces, fields start after its `)`
+    fields = stat[stat.rindex(b")") + 2 :].split()
+    ticks = int(fields[11]) + int(fields[12])
+    with open(f"/proc/{pid}/statm", "rb") as file:
+        rss = int(file.read().split()[1]) * PAGE_SIZE
+    try:
+        fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except PermissionError:
+        fds = -1
+    return ticks, rss, fds
+
+
+def read_processes(
+    pids: List[Tuple[str, int]]
+) -> List[Tuple[str, int, int, int, int]]:
+    # one sweep over every supervised pid, run in the executor
+    samples = []
+    for name, pid in pids:
+        try:
+            samples.append((name, pid, *read_process(pid)))
+        except (OSError, ValueError, IndexError):
+            # exited between the listing and the read
+            continue
+    return samples
+
+
+class ResourceStore:
+    # Latest sample of every process in parallel arrays, a process keeps
+    # its slot while it is sampled and slots of gone processes are reused
+
+    def __init__(self):
+        self.slots: Dict[str, int] = {}
+        self.free: List[int] = []
+        self.pids = array("q")
+        self.ticks = array("q")
+        self.sampled_at = array("d")
+        self.cpu = array("d")
+        self.rss = array("q")
+        self.fds = array("q")
+
+    def slot(self, name: str) -> int:
+        slot = self.slots.get(name)
+        if slot is not None:
+            return slot
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = len(self.pids)
+            for column in [self.pids, self.ticks, self.rss, self.fds]:
+                column.append(0)
+            for column in [self.sampled_at, self.cpu]:
+                column.append(0.0)
+        self.slots[name] = slot
+        self.pids[slot] = 0
+        return slot
+
+    def update(self, samples, now: float):
+        seen = set()
+        for name, pid, ticks, rss, fds in samples:
+            slot = self.slot(name)
+            seen.add(name)
+            if self.pids[slot] == pid and now > self.sampled_at[slot]:
+                elapsed = now - self.sampled_at[slot]
+                self.cpu[slot] = (
+                    (ticks - self.ticks[slot]) / CLOCK_TICKS / elapsed * 100
+                )
+            else:
+                # first sample of this pid, no cpu usage until the next one
+                self.cpu[slot] = 0.0
+            self.pids[slot] = pid
+            self.ticks[slot] = ticks
+            self.sampled_at[slot] = now
+            self.rss[slot] = rss
+            self.fds[slot] = fds
+        for name in [name for name in self.slots if name not in seen]:
+            self.free.append(self.slots.pop(name))
+
+    def get(self, name: str) -> dict:
+        slot = self.slots.get(name)
+        if slot is None:
+            return None
+        return {
+            "cpu": round(self.cpu[slot], 1),
+            "rss": self.rss[slot],
+            "fds": self.fds[slot],
+        }
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+
+class ResourceSampler:
+    def __init__(self):
+        self.interval = DEFAULT_SAMPLE_INTERVAL
+        self.store = ResourceStore()
+        self.get_pids: Callable[[], Iterable[Tuple[str, int]]] = None
+        self.task: asyncio.Task = None
+        self.sweep_time = 0.0
+        self.sweeps = 0
+
+    def configure(
+        self,
+        interval: float,
+        get_pids: Callable[[], Iterable[Tuple[str, int]]],
+    ):
+        self.get_pids = get_pids
+        if interval == self.interval and self.task:
+            return
+        self.interval = interval
+        self.stop()
+        if interval > 0:
+            logger.debug(f"Sampling process resources every {interval}s")
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                await self.sample()
+            except Exception as e:
+                logger.error(f"Error sampling process resources: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def sample(self):
+        started_at = time.monotonic()
+        samples = await asyncio.get_running_loop().run_in_executor(
+            None, read_processes, list(self.get_pids())
+        )
+        self.store.update(samples, time.monotonic())
+        self.sweeps += 1
+        self.sweep_time = time.monotonic() - started_at
+
+    def get(self, name: str) -> dict:
+        return self.store.get(name)
+
+    def get_stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "processes": len(self.store),
+            "sweep_time": round(self.sweep_time, 6),
+        }
+
+
+sampler = ResourceSampler()
@@ -0,0 +1,109 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPAWN_CONCURRENCY = 16
+DEFAULT_SPAWN_RATE = 0  # spawns per second, 0 means unlimited
+QUEUE_DEPTH_WARNING = 100
+
+
+class SpawnScheduler:
+    # A slot is taken when a process is about to be spawned and released
+    # once its child is forked, so at most `concurrency` spawns run at the
+    # same time, whatever the `starttime` of the processes.
+    # Waiters are served by priority (lower first), then in request order.
+
+    def __init__(
+        self,
+        concurrency: int = DEFAULT_SPAWN_CONCURRENCY,
+        rate: float = DEFAULT_SPAWN_RATE,
+    ):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.active = 0
+        self.spawned = 0
+        # from the start request to the running child, queueing included
+        self.latency_count = 0
+        self.latency_total = 0.0
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.next_spawn_at = 0.0
+        self.wakeup_handle: asyncio.TimerHandle = None
+
+    def configure(self, concurrency: int, rate: float):
+        logger.debug(
+            f"Spawn scheduler: concurrency {concurrency}, rate {rate}/s"
+        )
+        self.concurrency = concurrency
+        self.rate = rate
+        self.wakeup()
+
+    def queue_depth(self) -> int:
+        return sum(1 for *_, waiter in self.waiters if not waiter.done())
+
+    def get_stats(self) -> dict:
+        return {
+            "queued": self.queue_depth(),
+            "spawning": self.active,
+            "spawned": self.spawned,
+            "concurrency": self.concurrency,
+            "rate": self.rate,
+            "latency_count": self.latency_count,
+            "latency_total": round(self.latency_total, 6),
+        }
+
+    def record_latency(self, seconds: float):
+        self.latency_count += 1
+        self.latency_total += seconds
+
+    async def acquire(self, priority: int = 0):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), waiter))
+        if len(self.waiters) == QUEUE_DEPTH_WARNING:
+            logger.warning(
+                f"Spawn queue depth reached {QUEUE_DEPTH_WARNING} processes"
+            )
+        self.wakeup()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was granted while we were being cancelled
+                self.release()
+            raise
+
+    def release(self):
+        self.active -= 1
+        self.wakeup()
+
+    def wakeup(self):
+        if self.wakeup_handle:
+            self.wakeup_handle.cancel()
+            self.wakeup_handle = None
+        loop = asyncio.get_running_loop()
+        while self.waiters and self.active < self.concurrency:
+            *_, waiter = self.waiters[0]
+            if waiter.done():
+                heapq.heappop(self.waiters)
+                continue
+            now = loop.time()
+            if self.rate and now < self.next_spawn_at:
+                self.wakeup_handle = loop.call_at(
+                    self.next_spawn_at, self.wakeup
+                )
+                return
+            heapq.heappop(self.waiters)
+            if self.rate:
+                self.next_spawn_at = max(now, self.next_spawn_at) + (
+                    1 / self.rate
+                )
+            self.active += 1
+            self.spawned += 1
+            waiter.set_result(None)
+
+
+spawner = SpawnScheduler()
@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from definitions import ProgramDefinition
+from definitions import ProgramDefinition, TaskMasterDefinition
 from program import Program
 from typing import Dict
 import pathlib
@@ -13,7 +13,10 @@ class TaskMaster:
         default_factory=dict
     )
     programs: Dict[str, Program] = field(default_factory=dict)
+    settings: TaskMasterDefinition = None
     server: asyncio.Server = None
+    shutting_down: bool = False
     active_connections: Dict[str, asyncio.StreamWriter] = field(
         default_factory=dict
     )
+    active_streams: int = 0
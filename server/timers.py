@@ -0,0 +1,132 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from collections import defaultdict
+from typing import Callable, Dict, Set
+
+logger = logging.getLogger(__name__)
+
+# cancelled timers are only removed from the heap when they reach its top,
+# unless they become the majority of it
+COMPACT_THRESHOLD = 1024
+
+
+class Timer:
+    def __init__(
+        self, deadline: float, callback: Callable[[], None], group: str
+    ):
+        self.deadline = deadline
+        self.callback = callback
+        self.group = group
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            timers.discard(self)
+
+    def __lt__(self, other: "Timer") -> bool:
+        return self.deadline < other.deadline
+
+
+class TimerQueue:
+    # Every deadline of the server (starttime promotions, stoptime
+    # escalations, retry delays) lives in a single heap, and only the
+    # earliest one is scheduled on the event loop. Timers are grouped by
+    # program so killing a program cancels all of its timers at once.
+
+    def __init__(self):
+        self.heap = []
+        self.sequence = itertools.count()
+        self.groups: Dict[str, Set[Timer]] = defaultdict(set)
+        self.cancelled = 0
+        self.fired = 0
+        self.handle: asyncio.TimerHandle = None
+        self.handle_deadline: float = None
+
+    def schedule(
+        self, delay: float, callback: Callable[[], None], group: str = ""
+    ) -> Timer:
+        loop = asyncio.get_running_loop()
+        timer = Timer(loop.time() + max(delay, 0), callback, group)
+        heapq.heappush(self.heap, (timer.deadline, next(self.sequence), timer))
+        self.groups[group].add(timer)
+        if self.handle_deadline is None or timer.deadline < self.handle_deadline:
+            self.rearm()
+        return timer
+
+    def discard(self, timer: Timer):
+        timer.cancelled = True
+        self.cancelled += 1
+        self.forget(timer)
+        if self.cancelled > COMPACT_THRESHOLD and self.cancelled > len(
+            self.heap
+        ) // 2:
+            self.compact()
+
+    def cancel_group(self, group: str) -> int:
+        group_timers = self.groups.pop(group, set())
+        for timer in group_timers:
+            timer.cancelled = True
+        self.cancelled += len(group_timers)
+        if group_timers:
+            logger.debug(f"Cancelled {len(group_timers)} timers of {group}")
+            if self.cancelled > len(self.heap) // 2:
+                self.compact()
+        return len(group_timers)
+
+    def forget(self, timer: Timer):
+        group_timers = self.groups.get(timer.group)
+        if group_timers is None:
+            return
+        group_timers.discard(timer)
+        if not group_timers:
+            del self.groups[timer.group]
+
+    def compact(self):
+        self.heap = [entry for entry in self.heap if not entry[-1].cancelled]
+        heapq.heapify(self.heap)
+        self.cancelled = 0
+        self.rearm()
+
+    def rearm(self):
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+            self.handle_deadline = None
+        while self.heap and self.heap[0][-1].cancelled:
+            heapq.heappop(self.heap)
+            self.cancelled -= 1
+        if self.heap:
+            self.handle_deadline = self.heap[0][0]
+            self.handle = asyncio.get_running_loop().call_at(
+                self.handle_deadline, self.expire
+            )
+
+    def expire(self):
+        self.handle = None
+        self.handle_deadline = None
+        now = asyncio.get_running_loop().time()
+        while self.heap and self.heap[0][0] <= now:
+            *_, timer = heapq.heappop(self.heap)
+            if timer.cancelled:
+                self.cancelled -= 1
+                continue
+            # fired timers can no longer be cancelled
+            timer.cancelled = True
+            self.forget(timer)
+            self.fired += 1
+            try:
+                timer.callback()
+            except Exception as e:
+                logger.error(f"Error in timer of {timer.group}: {e}")
+        self.rearm()
+
+    def get_stats(self) -> dict:
+        return {
+            "pending": len(self.heap) - self.cancelled,
+            "fired": self.fired,
+        }
+
+
+timers = TimerQueue()
@@ -0,0 +1,287 @@
+import asyncio
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import logging
+import os
+import pathlib
+import struct
+import time
+from typing import Awaitable, Callable, List, Set
+
+from timers import Timer, timers
+
+logger = logging.getLogger(__name__)
+
+WATCH_MODES = ["off", "auto", "inotify", "poll"]
+DEFAULT_WATCH_MODE = "off"
+DEFAULT_WATCH_DEBOUNCE = 0.5  # seconds without writes before reloading
+POLL_INTERVAL = 1.0
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+)
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+
+class Inotify:
+    # Minimal inotify binding through the libc, directories are watched so
+    # files replaced by a rename (atomic writes) are still seen
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+
+    def watch(self, directory: str):
+        if directory in self.directories.values():
+            return
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), WATCH_MASK
+        )
+        if wd < 0:
+            logger.warning(
+                f"Cannot watch {directory}: "
+                f"{os.strerror(ctypes.get_errno())}"
+            )
+            return
+        self.directories[wd] = directory
+
+    def read(self) -> List[str]:
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        paths = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            directory = self.directories.get(wd)
+            if directory and name:
+                paths.append(os.path.join(directory, os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigWatcher:
+    # Reloads the configuration once its files stopped changing for
+    # `debounce` seconds. The reload parses and validates everything before
+    # applying anything, so a half-written file is reported and skipped.
+
+    def __init__(self):
+        self.mode = DEFAULT_WATCH_MODE
+        self.debounce = DEFAULT_WATCH_DEBOUNCE
+        self.config_file: pathlib.Path = None
+        self.on_change: Callable[[], Awaitable[str]] = None
+        self.config_cache = None
+        self.inotify: Inotify = None
+        self.poll_task: asyncio.Task = None
+        self.debounce_timer: Timer = None
+        self.detected_at: float = None
+        self.reload_task: asyncio.Task = None
+        self.pending = False
+        self.reloads = 0
+        self.last_latency: float = None
+
+    def configure(
+        self,
+        mode: str,
+        debounce: float,
+        config_file: pathlib.Path,
+        on_change: Callable[[], Awaitable[str]],
+        config_cache,
+    ):
+        # the cache of the config parser knows the included fragments
+        self.config_cache = config_cache
+        self.debounce = debounce
+        self.config_file = pathlib.Path(config_file).resolve()
+        self.on_change = on_change
+        if mode == self.mode:
+            self.refresh()
+            return
+        self.stop()
+        if mode == "off":
+            return
+        if mode in ["auto", "inotify"]:
+            try:
+                self.inotify = Inotify()
+                asyncio.get_running_loop().add_reader(
+                    self.inotify.fd, self.read_events
+                )
+                self.mode = mode
+                self.refresh()
+                logger.info("Watching the configuration with inotify")
+                return
+            except OSError as e:
+                self.inotify = None
+                logger.warning(f"inotify unavailable ({e}), polling instead")
+        self.mode = mode
+        self.poll_task = asyncio.create_task(self.poll())
+        logger.info(
+            f"Watching the configuration every {POLL_INTERVAL}s (mtime)"
+        )
+
+    def stop(self):
+        if self.inotify:
+            asyncio.get_running_loop().remove_reader(self.inotify.fd)
+            self.inotify.close()
+            self.inotify = None
+        if self.poll_task:
+            self.poll_task.cancel()
+            self.poll_task = None
+        if self.debounce_timer:
+            self.debounce_timer.cancel()
+            self.debounce_timer = None
+        self.mode = "off"
+
+    def include_patterns(self) -> List[str]:
+        patterns = (self.config_cache.main_config or {}).get("include") or []
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        return [
+            os.path.join(
+                self.config_file.parent, os.path.expanduser(str(pattern))
+            )
+            for pattern in patterns
+        ]
+
+    def watched_files(self) -> Set[str]:
+        files = {str(self.config_file)}
+        files.update(str(path) for path in self.config_cache.fragments)
+        for pattern in self.include_patterns():
+            files.update(
+                os.path.abspath(match) for match in glob.glob(pattern)
+            )
+        return files
+
+    def is_relevant(self, path: str) -> bool:
+        path = os.path.abspath(path)
+        if path in self.watched_files():
+            return True
+        return any(
+            fnmatch.fnmatch(path, os.path.abspath(pattern))
+            for pattern in self.include_patterns()
+        )
+
+    def refresh(self):
+        # new fragments may live in new directories
+        if not self.inotify:
+            return
+        directories = {os.path.dirname(path) for path in self.watched_files()}
+        for pattern in self.include_patterns():
+            directory = os.path.dirname(pattern)
+            if not glob.has_magic(directory) and os.path.isdir(directory):
+                directories.add(os.path.abspath(directory))
+        for directory in directories:
+            self.inotify.watch(directory)
+
+    def read_events(self):
+        changed = [
+            path for path in self.inotify.read() if self.is_relevant(path)
+        ]
+        if changed:
+            logger.debug(f"Configuration changed: {', '.join(set(changed))}")
+            self.changed()
+
+    def signature(self) -> set:
+        signature = set()
+        for path in self.watched_files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature.add((path, stat.st_mtime_ns, stat.st_size))
+        return signature
+
+    async def poll(self):
+        signature = self.signature()
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            new_signature = self.signature()
+            if new_signature != signature:
+                signature = new_signature
+                logger.debug("Configuration changed (mtime)")
+                self.changed()
+
+    def changed(self):
+        # a burst of writes only triggers one reload, once it is over
+        if self.detected_at is None:
+            self.detected_at = time.monotonic()
+        if self.debounce_timer:
+            self.debounce_timer.cancel()
+        self.debounce_timer = timers.schedule(self.debounce, self.settled)
+
+    def settled(self):
+        self.debounce_timer = None
+        if self.reload_task and not self.reload_task.done():
+            # reloaded again once the running reload is over
+            self.pending = True
+            return
+        self.reload_task = asyncio.create_task(self.reload())
+
+    async def reload(self):
+        detected_at, self.detected_at = self.detected_at, None
+        try:
+            result = await self.on_change()
+            latency = time.monotonic() - detected_at
+            if result.startswith("Error"):
+                # kept until the next change, the running config is intact
+                logger.warning(
+                    f"Configuration change rejected after {latency:.3f}s: "
+                    f"{result}"
+                )
+            else:
+                self.reloads += 1
+                self.last_latency = round(latency, 6)
+                logger.info(
+                    f"Configuration change applied {latency:.3f}s "
+                    f"after detection: {result}"
+                )
+        except Exception as e:
+            logger.error(f"Automatic reload failed: {e}")
+        self.refresh()
+        if self.pending:
+            self.pending = False
+            self.detected_at = time.monotonic()
+            self.reload_task = asyncio.create_task(self.reload())
+
+    def get_stats(self) -> dict:
+        return {
+            "mode": "inotify"
+            if self.inotify
+            else "poll"
+            if self.poll_task
+            else "off",
+            "debounce": self.debounce,
+            "reloads": self.reloads,
+            "last_latency": self.last_latency,
+        }
+
+
+watcher = ConfigWatcher()